@@ -0,0 +1,88 @@
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Marvin connection that reuses HTTP(S) connections between API calls
+# Remi Bergsma - rbergsma@schubergphilis.com
+
+# Import our dependencies
+import requests
+from requests.adapters import HTTPAdapter
+from marvin.cloudstackConnection import cloudConnection
+
+
+class PooledCloudConnection(cloudConnection):
+
+    # Init function
+    def __init__(self, mgtSvr, poolSize=10, **kwargs):
+        super(PooledCloudConnection, self).__init__(mgtSvr, **kwargs)
+        self.poolSize = poolSize
+        self.session = self._newSession()
+
+    # One session for all calls, so connections (and TLS sessions) are
+    # kept alive. Threads block for a free connection when all are in use
+    def _newSession(self):
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.poolSize,
+            pool_block=True)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    # Start over with new connections, for use in a forked process. The
+    # connections of the parent are left alone, as it still uses them.
+    def reset(self):
+        self.session = self._newSession()
+
+    def __copy__(self):
+        return PooledCloudConnection(
+            self.mgtSvr,
+            poolSize=self.poolSize,
+            port=self.port,
+            user=self.user,
+            passwd=self.passwd,
+            apiKey=self.apiKey,
+            securityKey=self.securityKey,
+            asyncTimeout=self.asyncTimeout,
+            logging=self.logging,
+            scheme=self.protocol,
+            path=self.path)
+
+    # Same as Marvin's request, but over the pooled session
+    def request(self, command, auth=True, payload={}, method='GET'):
+        payload = dict(payload)
+        payload["command"] = command
+        payload["response"] = "json"
+
+        if auth:
+            payload["apiKey"] = self.apiKey
+            payload["signature"] = self.sign(payload)
+
+        try:
+            if method == 'POST':
+                return self.session.post(self.baseurl, params=payload)
+            return self.session.get(self.baseurl, params=payload)
+        except requests.RequestException as e:
+            self.logging.debug("Request to %s failed: %s" % (self.baseurl, e))
+            raise e
+
+    # Close all pooled connections
+    def close(self):
+        self.session.close()
@@ -32,6 +32,10 @@ import subprocess
 from subprocess import Popen, PIPE
 import pprint
 import re
+import math
+import json
+from multiprocessing.pool import ThreadPool
+from clustercapacity import ClusterCapacity
 
 # Marvin
 try:
@@ -39,10 +43,18 @@ try:
     from marvin.cloudstackException import cloudstackAPIException
     from marvin.cloudstackAPI import *
     from marvin import cloudstackAPI
+    from marvin import jsonHelper
 except:
     print "Error: Please install Marvin to talk to the CloudStack API:"
     print "       pip install ./marvin/Marvin-0.1.0.tar.gz (file is in this repository)"
     sys.exit(1)
+# Pooled HTTP connections to the CloudStack API
+try:
+    from cloudstackconnection import PooledCloudConnection
+except Exception as e:
+    print "Error: Unable to load the pooled CloudStack connection: " + str(e)
+    print "       pip install requests"
+    sys.exit(1)
 # Colored terminals
 try:
     from clint.textui import colored
@@ -78,6 +90,14 @@ class CloudStackOps(CloudStackOpsBase):
         self.pp = pprint.PrettyPrinter(depth=6)
         self.ssh = None
         self.xenserver = None
+        self.pagesize = None
+        self.pageFetchThreads = 5
+        self.apiPoolSize = 10
+        self.snapshot = None
+        self.nameCache = {}
+        self.nameCacheLoaded = False
+        self.nameCacheTTL = 3600
+        self.nameCacheFile = None
 
         self.printWelcome()
         self.checkScreenAlike()
@@ -163,6 +183,17 @@ class CloudStackOps(CloudStackOpsBase):
             print "Hint: Setup the local config file 'config', using 'config.sample' as a starting point. See documentation."
             sys.exit(1)
 
+        # Optional: number of HTTP connections to keep open to the API
+        if config.has_option('cloudstackOps', 'api_pool_size'):
+            self.apiPoolSize = config.getint('cloudstackOps', 'api_pool_size')
+
+        # Optional: how long name to ID lookups are cached, and where
+        if config.has_option('cloudstackOps', 'name_cache_ttl'):
+            self.nameCacheTTL = config.getint('cloudstackOps', 'name_cache_ttl')
+        if config.has_option('cloudstackOps', 'name_cache_file'):
+            self.nameCacheFile = expanduser(
+                config.get('cloudstackOps', 'name_cache_file'))
+
     # Read and parse config file
     def parseConfig(self, configFile):
         if self.DEBUG == 1:
@@ -227,8 +258,9 @@ class CloudStackOps(CloudStackOpsBase):
         if self.DEBUG == 1:
             print "Debug: apiserver=" + self.apiserver + " apiKey=" + self.apikey + " securityKey=" + self.secretkey + " port=" + str(self.apiport) + " scheme=" + self.apiprotocol
         try:
-            self.cloudstack = cloudConnection(
+            self.cloudstack = PooledCloudConnection(
                 self.apiserver,
+                poolSize=self.apiPoolSize,
                 apiKey=self.apikey,
                 securityKey=self.secretkey,
                 asyncTimeout=14400,
@@ -252,8 +284,17 @@ class CloudStackOps(CloudStackOpsBase):
         if apicall is None:
             return 1
 
+        # Answer list calls from the local snapshot when we use one
+        if self.snapshot is not None:
+            data = self.snapshot.query(apicall)
+            if data is not False:
+                return data
+
         try:
-            data = self.cloudstack.marvin_request(apicall)
+            if self._isPagedCall(apicall):
+                data = self._callAPIPaged(apicall)
+            else:
+                data = self.cloudstack.marvin_request(apicall)
             if data is None and self.DEBUG == 1:
                 print "Warning: Received None object from CloudStack API"
 
@@ -276,6 +317,89 @@ class CloudStackOps(CloudStackOpsBase):
 
         return data
 
+    # List calls that did not ask for a specific page are paged by us
+    def _isPagedCall(self, apicall):
+        if not apicall.__class__.__name__.startswith('list'):
+            return False
+        if not hasattr(apicall, 'pagesize') or not hasattr(apicall, 'page'):
+            return False
+        if apicall.page is not None or apicall.pagesize is not None:
+            return False
+        return self._getPageSize() > 0
+
+    # Get (and remember) default.page.size of the management server
+    def _getPageSize(self):
+        if self.pagesize is not None:
+            return self.pagesize
+
+        apicall = listConfigurations.listConfigurationsCmd()
+        apicall.name = "default.page.size"
+        apicall.page = 1
+        apicall.pagesize = 1
+        try:
+            result = self.cloudstack.marvin_request(apicall)
+            self.pagesize = int(result[0].value)
+        except:
+            # Unable to tell, so do not page at all
+            self.pagesize = 0
+
+        if self.DEBUG == 1:
+            print "DEBUG: Using page size " + str(self.pagesize)
+        return self.pagesize
+
+    # Fetch one page of a list call, returns total count and the page items
+    def _callAPIPage(self, cmdname, payload, page):
+        payload = dict(payload)
+        payload['page'] = page
+        payload['pagesize'] = self.pagesize
+
+        response = self.cloudstack.request(
+            cmdname, self.cloudstack.auth, payload=payload)
+        try:
+            returnObj = response.json()
+        except TypeError:
+            returnObj = response.json
+
+        # Marvin drops the count, so look it up in the raw response first
+        count = 0
+        for responseName, body in returnObj.iteritems():
+            if responseName != 'cloudstack-version' and isinstance(body, dict):
+                count = int(body.get('count', 0))
+
+        items = jsonHelper.getResultObj(returnObj)
+        if items is None:
+            items = []
+        return count, items
+
+    # Fetch all pages of a list call; the first page tells us how many
+    # there are, the remaining ones are fetched concurrently
+    def _callAPIPaged(self, apicall):
+        cmdname, isAsync, payload = self.cloudstack.sanitize_command(apicall)
+
+        count, data = self._callAPIPage(cmdname, payload, 1)
+        numberOfPages = int(math.ceil(count / float(self.pagesize)))
+
+        if numberOfPages > 1:
+            pages = range(2, numberOfPages + 1)
+            if self.DEBUG == 1:
+                print "DEBUG: " + cmdname + " returned " + str(count) + " items, fetching " + str(len(pages)) + " more pages"
+
+            pool = ThreadPool(min(self.pageFetchThreads, len(pages)))
+            try:
+                results = pool.map(
+                    lambda page: self._callAPIPage(cmdname, payload, page)[1],
+                    pages)
+            finally:
+                pool.close()
+                pool.join()
+
+            for result in results:
+                data = data + result
+
+        if len(data) == 0:
+            return None
+        return data
+
     # Remove empty arguments
     def remove_empty_values(self, d):
         if isinstance(d, dict):
@@ -296,35 +420,15 @@ class CloudStackOps(CloudStackOpsBase):
         isProjectVm = (
             args['isProjectVm']) if 'isProjectVm' in args else 'false'
 
-        # Find out which API call to make
-        if csApiCall == "listVirtualMachines":
-            apicall = listVirtualMachines.listVirtualMachinesCmd()
-        elif csApiCall == "listClusters":
-            apicall = listClusters.listClustersCmd()
-        elif csApiCall == "listStoragePools":
-            apicall = listStoragePools.listStoragePoolsCmd()
-        elif csApiCall == "listRouters":
-            apicall = listRouters.listRoutersCmd()
-        elif csApiCall == "listDomains":
-            apicall = listDomains.listDomainsCmd()
-        elif csApiCall == "listProjects":
-            apicall = listProjects.listProjectsCmd()
-            isProjectVm = 'false'
-        elif csApiCall == "listHosts":
-            apicall = listHosts.listHostsCmd()
-        elif csApiCall == "listZones":
-            apicall = listZones.listZonesCmd()
-        elif csApiCall == "listPods":
-            apicall = listPods.listPodsCmd()
-        elif csApiCall == "listZones":
-            apicall = listZones.listZonesCmd()
-        else:
-            print "No API command to call"
-            sys.exit(1)
-
-        if isProjectVm == 'true':
-            apicall.projectid = "-1"
+        # Did we look it up before?
+        cacheKey = self._nameCacheKey(csApiCall, csname, isProjectVm, listAll)
+        csnameID = self._getCachedName(cacheKey)
+        if csnameID is not None:
+            if self.DEBUG == 1:
+                print "DEBUG: Found: '%s' with ID %s in name cache." % (csname, csnameID)
+            return csnameID
 
+        apicall = self._getNameLookupCall(csApiCall, isProjectVm)
         if csname.startswith('i-'):
             apicall.keyword = str(csname)
 
@@ -336,7 +440,11 @@ class CloudStackOps(CloudStackOpsBase):
 
         found_counter = 0
         try:
-            data = self.cloudstack.marvin_request(apicall)
+            data = False
+            if self.snapshot is not None:
+                data = self.snapshot.query(apicall)
+            if data is False:
+                data = self.cloudstack.marvin_request(apicall)
             if (data is None or len(data) == 0) and self.DEBUG == 1:
                 print "Warning: Received None object from CloudStack API"
 
@@ -380,8 +488,144 @@ class CloudStackOps(CloudStackOpsBase):
         if self.DEBUG == 1:
             print "DEBUG: Found: '%s' with ID %s." % (csname, csnameID)
 
+        self._setCachedName(cacheKey, csnameID)
         return csnameID
 
+    # Lookup the IDs of many names using a single list call. Returns a dict
+    # of name to ID, names that are not found or not unique are left out.
+    def checkCloudStackNames(self, args):
+
+        # Handle arguments
+        csnames = (args['csnames']) if 'csnames' in args else []
+        csApiCall = (args['csApiCall']) if 'csApiCall' in args else ''
+        listAll = (args['listAll']) if 'listAll' in args else 'false'
+        isProjectVm = (
+            args['isProjectVm']) if 'isProjectVm' in args else 'false'
+
+        csnameIDs = {}
+        todo = []
+        for csname in csnames:
+            csnameID = self._getCachedName(
+                self._nameCacheKey(csApiCall, csname, isProjectVm, listAll))
+            if csnameID is not None:
+                csnameIDs[csname] = csnameID
+            elif csname not in todo:
+                todo.append(csname)
+
+        if len(todo) == 0:
+            return csnameIDs
+
+        apicall = self._getNameLookupCall(csApiCall, isProjectVm)
+        if listAll == 'true':
+            apicall.listAll = "true"
+
+        data = self._callAPI(apicall)
+        if data == 1:
+            return 1
+
+        found = {}
+        for d in (data or []):
+            for csname in set([d.name, getattr(d, 'instancename', None)]):
+                if csname in todo:
+                    found.setdefault(csname, []).append(d.id)
+
+        for csname in todo:
+            if csname not in found:
+                print "Warning: '%s' could not be located in CloudStack database using '%s'" % (csname, csApiCall)
+            elif len(found[csname]) > 1:
+                print "Warning: '%s' could not be located in CloudStack database using '%s' because it is not unique" % (csname, csApiCall)
+            else:
+                csnameIDs[csname] = found[csname][0]
+                self._setCachedName(
+                    self._nameCacheKey(csApiCall, csname, isProjectVm, listAll),
+                    found[csname][0])
+        return csnameIDs
+
+    # The list call used to lookup a name
+    def _getNameLookupCall(self, csApiCall, isProjectVm):
+        if csApiCall == "listVirtualMachines":
+            apicall = listVirtualMachines.listVirtualMachinesCmd()
+        elif csApiCall == "listClusters":
+            apicall = listClusters.listClustersCmd()
+        elif csApiCall == "listStoragePools":
+            apicall = listStoragePools.listStoragePoolsCmd()
+        elif csApiCall == "listRouters":
+            apicall = listRouters.listRoutersCmd()
+        elif csApiCall == "listDomains":
+            apicall = listDomains.listDomainsCmd()
+        elif csApiCall == "listProjects":
+            apicall = listProjects.listProjectsCmd()
+            isProjectVm = 'false'
+        elif csApiCall == "listHosts":
+            apicall = listHosts.listHostsCmd()
+        elif csApiCall == "listZones":
+            apicall = listZones.listZonesCmd()
+        elif csApiCall == "listPods":
+            apicall = listPods.listPodsCmd()
+        elif csApiCall == "listZones":
+            apicall = listZones.listZonesCmd()
+        else:
+            print "No API command to call"
+            sys.exit(1)
+
+        if isProjectVm == 'true':
+            apicall.projectid = "-1"
+
+        return apicall
+
+    # Key of a name lookup in the name cache
+    def _nameCacheKey(self, csApiCall, csname, isProjectVm, listAll):
+        return "|".join([csApiCall, str(csname), isProjectVm, listAll])
+
+    # Get an ID from the name cache, None if unknown or expired
+    def _getCachedName(self, cacheKey):
+        self._loadNameCache()
+        entry = self.nameCache.get(cacheKey)
+        if entry is None:
+            return None
+        if time.time() - entry[1] > self.nameCacheTTL:
+            del self.nameCache[cacheKey]
+            return None
+        return entry[0]
+
+    # Add an ID to the name cache
+    def _setCachedName(self, cacheKey, csnameID):
+        if self.nameCacheTTL <= 0:
+            return
+        self._loadNameCache()
+        self.nameCache[cacheKey] = [csnameID, int(time.time())]
+        self._saveNameCache()
+
+    # Read the lookups of this cloud from the name cache file, once
+    def _loadNameCache(self):
+        if self.nameCacheLoaded:
+            return
+        self.nameCacheLoaded = True
+        if self.nameCacheFile is None or not os.path.isfile(self.nameCacheFile):
+            return
+        try:
+            with open(self.nameCacheFile) as f:
+                self.nameCache.update(json.load(f).get(self.apiurl, {}))
+        except Exception as err:
+            print "Warning: Cannot read name cache file '" + self.nameCacheFile + "': " + str(err)
+
+    # Write the name cache file, keeping the lookups of other clouds
+    def _saveNameCache(self):
+        if self.nameCacheFile is None:
+            return
+        try:
+            data = {}
+            if os.path.isfile(self.nameCacheFile):
+                with open(self.nameCacheFile) as f:
+                    data = json.load(f)
+            data[self.apiurl] = self.nameCache
+            tmpfile = self.nameCacheFile + ".tmp"
+            with open(tmpfile, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmpfile, self.nameCacheFile)
+        except Exception as err:
+            print "Warning: Cannot write name cache file '" + self.nameCacheFile + "': " + str(err)
+
     # Find Random storagePool for Cluster
     def getRandomStoragePool(self, clusterID):
         apicall = listStoragePools.listStoragePoolsCmd()
@@ -480,6 +724,8 @@ class CloudStackOps(CloudStackOpsBase):
         apicall.projectid = (
             '-1') if 'isProjectVm' in args and args['isProjectVm'] == 'true' else None
         apicall.hostid = (str(args['hostid'])) if 'hostid' in args else None
+        apicall.podid = (str(args['podid'])) if 'podid' in args else None
+        apicall.zoneid = (str(args['zoneid'])) if 'zoneid' in args else None
         apicall.domainid = (
             str(args['domainid'])) if 'domainid' in args else None
         apicall.keyword = (
@@ -525,6 +771,8 @@ class CloudStackOps(CloudStackOpsBase):
         apicall.projectid = (
             '-1') if 'isProjectVm' in args and args['isProjectVm'] == 'true' else None
         apicall.hostid = (str(args['hostid'])) if 'hostid' in args else None
+        apicall.podid = (str(args['podid'])) if 'podid' in args else None
+        apicall.zoneid = (str(args['zoneid'])) if 'zoneid' in args else None
         apicall.domainid = (
             str(args['domainid'])) if 'domainid' in args else None
         apicall.state = (str(args['state'])) if 'state' in args else None
@@ -565,6 +813,7 @@ class CloudStackOps(CloudStackOpsBase):
         apicall.state = (str(args['state'])) if 'state' in args else None
         apicall.systemvmtype = (
             str(args['systemvmtype'])) if 'systemvmtype' in args else None
+        apicall.podid = (str(args['podid'])) if 'podid' in args else None
         apicall.zoneid = (str(args['zoneid'])) if 'zoneid' in args else None
 
         # Call CloudStack API
@@ -789,53 +1038,17 @@ class CloudStackOps(CloudStackOpsBase):
     def listVolumes(self, storageid, isProjectVm):
         apicall = listVolumes.listVolumesCmd()
         apicall.storageid = storageid
+        apicall.listAll = "true"
 
         if isProjectVm == 'true':
             apicall.projectid = "-1"
 
-        # get default.page.size
-        result = self.getConfiguration("default.page.size")
-        apicall.listAll = "true"
-        apicall.pagesize = result[0].value
-
-        # Call API multiple times to get all volumes
-        page = 0
-        apicall.page = page
-
-        # As long as we receive useful output, keep going
-        volumes = []
-        while result is not None:
-            page = page + 1
-            apicall.page = page
-            result = self._listVolumesCall(apicall)
-            if result is not None:
-                if 'volumes' in locals():
-                    volumes = volumes + result
-                else:
-                    volumes = result
-
+        # Call CloudStack API, all pages are fetched by _callAPI
+        volumes = self._callAPI(apicall)
+        if volumes is None or volumes == 1:
+            return []
         return volumes
 
-    # Internal function used by listVolumes
-    def _listVolumesCall(self, apicall):
-        try:
-            data = self.cloudstack.marvin_request(apicall)
-            if (data is None) and self.DEBUG == 1:
-                print "Warning: Received None object from CloudStack API"
-
-            if self.DEBUG == 1:
-                print "DEBUG: received data:"
-                print data
-
-        except Exception as err:
-            print "Error: " + str(err)
-            return 1
-        except urllib2.HTTPError as e:
-            print "Error: Command failed: " + str(e.msg)
-            return 1
-
-        return data
-
     # Calculate storage usage of vm
     def calculateVirtualMachineStorageUsage(self, vmid, isProjectVm):
         # Get vm volume data
@@ -847,6 +1060,32 @@ class CloudStackOps(CloudStackOpsBase):
             return storageSize
         return 0
 
+    # Calculate storage usage of all vms in a zone using a single paged
+    # listVolumes call, returns a dict with the usage per vm id
+    def getVirtualMachinesStorageUsage(self, args):
+        args = self.remove_empty_values(args)
+
+        apicall = listVolumes.listVolumesCmd()
+        apicall.listAll = "true"
+        apicall.zoneid = (str(args['zoneid'])) if 'zoneid' in args else None
+        apicall.domainid = (
+            str(args['domainid'])) if 'domainid' in args else None
+        apicall.projectid = (
+            '-1') if 'isProjectVm' in args and args['isProjectVm'] == 'true' else None
+
+        # Call CloudStack API
+        volumes = self._callAPI(apicall)
+
+        storageUsage = {}
+        if volumes is None or volumes == 1:
+            return storageUsage
+        for vol in volumes:
+            if vol.virtualmachineid is None:
+                continue
+            storageUsage[vol.virtualmachineid] = storageUsage.get(
+                vol.virtualmachineid, 0) + (vol.size / 1024 / 1024 / 1024)
+        return storageUsage
+
     # list clusters
     def listClusters(self, args):
         args = self.remove_empty_values(args)
@@ -1084,9 +1323,11 @@ class CloudStackOps(CloudStackOpsBase):
         else:
             return None
 
-    def getDetachedVolumes(self, storagepoolid):
+    def getDetachedVolumes(self, storagepoolid, volumes=None):
 
-        volumes = self.listVolumes(storagepoolid,False)
+        # volumes of the storage pool may be passed when the caller has them already
+        if volumes is None:
+            volumes = self.listVolumes(storagepoolid,False)
 
         orphans = []
 
@@ -1200,8 +1441,6 @@ class CloudStackOps(CloudStackOpsBase):
             args['zoneid']) > 0 else ""
         apicall.templatefilter = (str(args['templatefilter'])) if 'templatefilter' in args and len(
             args['templatefilter']) > 0 else "featured"
-        apicall.page = 1
-        apicall.pagesize = 1500
 
         # Call CloudStack API
         return self._callAPI(apicall)
@@ -1321,6 +1560,14 @@ class CloudStackOps(CloudStackOpsBase):
         vmcount_previous = 0
         vmcount_same_counter = 0
 
+        # Follow the vms on the host using XAPI events when we can
+        watcher = None
+        if self.xenserver is not None:
+            watcher = self.xenserver.xapi.watch_resident_vms(
+                foundHostData.ipaddress, hostname)
+            if watcher is None:
+                print "Note: No XAPI events for host " + hostname + ", polling its vm count over SSH instead"
+
         # Check result
         while True:
             hostData = self.getHostData({'hostname': hostname})
@@ -1329,6 +1576,9 @@ class CloudStackOps(CloudStackOpsBase):
                     foundHostData = host
 
                 # Get vm count
+                if watcher is not None:
+                    vmcount = str(watcher.count)
+                    continue
                 try:
                     retcode, vmcount = self.ssh.getXapiVmCount(
                         foundHostData.ipaddress)
@@ -1339,8 +1589,13 @@ class CloudStackOps(CloudStackOpsBase):
                 print "Note: Resource state currently is '" + foundHostData.resourcestate + "'. Number of VMs still to be migrated: " + vmcount + "    "
                 sys.stdout.write("\033[F")
 
-                # Wait before checking again
-                time.sleep(6)
+                # Wait before checking again, or until a vm left the host
+                if watcher is not None:
+                    if watcher.wait(6) is None:
+                        print "Warning: Lost XAPI events for host " + hostname + ", polling its vm count over SSH instead"
+                        watcher = None
+                else:
+                    time.sleep(6)
 
             elif foundHostData.resourcestate == "Enabled":
                 print "Note: Resource state currently is '" + foundHostData.resourcestate + "', maintenance must have been cancelled, returning"
@@ -1380,6 +1635,22 @@ class CloudStackOps(CloudStackOpsBase):
             self.cancelHostMaintenance(hostID)
             return False
 
+    # Wait until all hosts of a cluster are Up, for at most timeout seconds
+    def waitForClusterHostsUp(self, clusterID, timeout):
+        deadline = time.time() + timeout
+        while True:
+            clusterHostsData = self.getAllHostsFromCluster(clusterID)
+            if clusterHostsData is not None and clusterHostsData != 1:
+                down = [h.name for h in clusterHostsData
+                        if h.state != "Up" and h.resourcestate != "Maintenance"]
+                if len(down) == 0:
+                    return True
+                if self.DEBUG == 1:
+                    print "Debug: Hosts not Up yet: " + ", ".join(down)
+            if time.time() >= deadline:
+                return False
+            time.sleep(5)
+
     def safeToPutInMaintenance(self, clusterid):
         # Get all hosts
         clusterHostsData = self.getAllHostsFromCluster(clusterid)
@@ -1411,16 +1682,21 @@ class CloudStackOps(CloudStackOpsBase):
                          "# VMs",
                          "Bond Status"])
 
-        for clusterhost in clusterHostsData:
+        if not poolmaster:
+            if self.DEBUG == 1:
+                print "Debug: Looking for poolmaster"
+            poolmaster = self.xenserver.get_poolmaster(clusterHostsData[0])
 
-            # Some progress indication
+        # Some progress indication
+        for clusterhost in clusterHostsData:
             sys.stdout.write(clusterhost.name + ", ")
-            sys.stdout.flush()
+        sys.stdout.flush()
 
-            if not poolmaster:
-                if self.DEBUG == 1:
-                    print "Debug: Looking for poolmaster"
-                poolmaster = self.xenserver.get_poolmaster(clusterhost)
+        # Ask all hypervisors at the same time
+        results = self.xenserver.fan_out(
+            clusterHostsData, self._checkHypervisor, checkBonds)
+
+        for clusterhost in clusterHostsData:
 
             # Poolmaster
             if clusterhost.name == poolmaster.strip():
@@ -1428,23 +1704,8 @@ class CloudStackOps(CloudStackOpsBase):
             else:
                 pm = ""
 
-            # Check bonds
-            if checkBonds is True:
-                try:
-                    bondscripts = self.xenserver.put_scripts(
-                        clusterhost)
-                    bondstatus = self.xenserver.get_bond_status(
-                        clusterhost)
-                except:
-                    bondstatus = "UNKNOWN"
-            else:
-                bondstatus = "UNTESTED"
-
-            try:
-                vmcount = self.xenserver.host_get_vms(
-                    clusterhost)
-            except:
-                vmcount = "UNKNOWN"
+            vmcount, bondstatus = results.get(
+                clusterhost.name, ("UNKNOWN", "UNKNOWN")) or ("UNKNOWN", "UNKNOWN")
 
             # Table
             t.add_row([clusterhost.name,
@@ -1459,6 +1720,27 @@ class CloudStackOps(CloudStackOpsBase):
         # Print table
         print t.get_string(sortby="Hostname")
 
+    # Get the vm count and bond status of a hypervisor
+    def _checkHypervisor(self, clusterhost, checkBonds=False):
+        # Check bonds
+        if checkBonds is True:
+            try:
+                bondscripts = self.xenserver.put_scripts(
+                    clusterhost)
+                bondstatus = self.xenserver.get_bond_status(
+                    clusterhost)
+            except:
+                bondstatus = "UNKNOWN"
+        else:
+            bondstatus = "UNTESTED"
+
+        try:
+            vmcount = self.xenserver.host_get_vms(
+                clusterhost)
+        except:
+            vmcount = "UNKNOWN"
+        return str(vmcount), str(bondstatus)
+
     # Print cluster table
     def printCluster(self, clusterID):
         clusterData = self.listClusters({'clusterid': clusterID})
@@ -1499,6 +1781,19 @@ class CloudStackOps(CloudStackOpsBase):
         # Print table
         print t
 
+    # Group vms, routers or systemvms by the id of the host they run on
+    def groupByHost(self, vmdata):
+        vmsByHost = {}
+        if vmdata is None or vmdata == 1:
+            return vmsByHost
+        for vm in vmdata:
+            if vm.hostid is None:
+                continue
+            if vm.hostid not in vmsByHost:
+                vmsByHost[vm.hostid] = []
+            vmsByHost[vm.hostid].append(vm)
+        return vmsByHost
+
     # Check vm's still running on this host
     def getVirtualMachinesRunningOnHost(self, hostID):
 
@@ -1523,70 +1818,36 @@ class CloudStackOps(CloudStackOpsBase):
 
         return all_vmdata
 
-    # Find suitable host
+    # Use new API connections, for use in a forked process so it does not
+    # talk over the connections of its parent
+    def resetConnection(self):
+        if isinstance(self.cloudstack, PooledCloudConnection):
+            self.cloudstack.reset()
+
+    # Load the free memory of the hosts in a cluster
+    def getClusterCapacity(self, clusterID):
+        clusterHosts = self.getHostsFromCluster(clusterID)
+        if clusterHosts == 1 or clusterHosts is None:
+            clusterHosts = []
+        return ClusterCapacity(clusterHosts, self.DEBUG)
+
+    # Find suitable host. Pass a capacity model to place several vm's without
+    # listing the hosts again for each of them.
     def findBestMigrationHost(
             self,
             clusterID,
             currentHostname,
-            requestedMemory):
-        # All hosts from cluster
-        clusterHosts = self.getHostsFromCluster(clusterID)
-        bestAvailableMemory = 0
-        migrationHost = False
-        if clusterHosts != 1 and clusterHosts is not None:
-            for h in clusterHosts:
-                # Skip the current hostname
-                if h.name == currentHostname:
-                    continue
-                # Only hosts have enough resources
-                if h.suitableformigration == False:
-                    continue
-                # And are not in Maintenance, Error or Disabled
-                if h.resourcestate == "Disabled" or h.resourcestate == "Maintenance" or h.resourcestate == "Error":
-                    continue
-                # Check memory availability
-                # Available memory in Bytes
-                memoryavailable = h.memorytotal - h.memoryallocated
-                if self.DEBUG == 1:
-                    print "Note: host " + h.name + " has free mem: " + str(memoryavailable)
-                # Don't try if host has less than 10GB memory left or if vm does not fit at all
-                # vm.memory is in Mega Bytes
-                if requestedMemory is not None:
-                    if memoryavailable < (
-                            10 *
-                            1024 *
-                            1024 *
-                            1024) or memoryavailable < (
-                            requestedMemory *
-                            1024 *
-                            1024):
-                        if self.DEBUG == 1:
-                            print "Warning: Skipping " + h.name + " as it has not enough memory."
-                        continue
-                else:
-                    if memoryavailable < (10 * 1024 * 1024 * 1024):
-                        if self.DEBUG == 1:
-                            print "Warning: Skipping " + h.name + " as it has not enough memory."
-                        continue
-
-                # Find host with most memory free
-                if bestAvailableMemory == 0:
-                    if self.DEBUG == 1:
-                        print "Note: Found possible migration host '" + h.name + "' with free memory: " + str(memoryavailable)
-                    migrationHost = h
-                    bestAvailableMemory = memoryavailable
-                elif memoryavailable > bestAvailableMemory:
-                    if self.DEBUG == 1:
-                        print "Note: Found better migration host '" + h.name + "' with free memory: " + str(memoryavailable)
-                    migrationHost = h
-                    bestAvailableMemory = memoryavailable
-                elif self.DEBUG == 1:
-                    print "Note: Found migration host '" + h.name + "' with free memory: " + str(memoryavailable) + " but there are already better (or equal) candidates so skipping this one"
-
-        return migrationHost
-
-    # Migrate all vm's and empty hypervisor
-    def emptyHypervisor(self, hostID):
+            requestedMemory,
+            skipHostnames=[],
+            capacity=None):
+        if capacity is None:
+            capacity = self.getClusterCapacity(clusterID)
+        return capacity.findHost(
+            requestedMemory, skipHostnames + [currentHostname])
+
+    # Migrate all vm's and empty hypervisor. Up to maxConcurrent migrations
+    # run at the same time, with at most maxPerDestination to the same host.
+    def emptyHypervisor(self, hostID, maxConcurrent=1, maxPerDestination=2):
         # Host data
         hostData = self.getHostData({'hostid': hostID})
         foundHostData = hostData[0]
@@ -1605,70 +1866,144 @@ class CloudStackOps(CloudStackOpsBase):
 
         if all_vmdata is None:
             print "Warning: No vm's to be moved found on '" + hostname + "'.."
+            return True
+
+        if self.DRYRUN == 1:
+            print "Note: Testing if we would be able to migrate the vm's on hypervisor '" + hostname + "':"
         else:
-            if self.DRYRUN == 1:
-                print "Note: Testing if we would be able to migrate the vm's on hypervisor '" + hostname + "':"
-            else:
-                print "Note: Migrating the vm's on hypervisor '" + hostname + "':"
+            print "Note: Migrating the vm's on hypervisor '" + hostname + "':"
 
-            for vmdata in all_vmdata:
-                if vmdata is None:
+        pending = []
+        for vmdata in all_vmdata:
+            if vmdata is None:
+                continue
+            for vm in vmdata:
+                pending.append(vm)
+
+        if self.DRYRUN == 1:
+            for vm in pending:
+                sys.stdout.write(vm.name + ", ")
+                sys.stdout.flush()
+            return True
+
+        # Free memory of the cluster, updated as we place vm's
+        capacity = self.getClusterCapacity(foundHostData.clusterid)
+
+        # Running migrations by job id, and how many go to each host
+        inflight = {}
+        perDestination = {}
+        while len(pending) > 0 or len(inflight) > 0:
+            # Start migrations as long as we are below the limits
+            while len(pending) > 0 and len(inflight) < maxConcurrent:
+                vm = pending[0]
+                busyHosts = [h for h in perDestination.keys()
+                             if perDestination[h] >= maxPerDestination]
+                migrationHost = self.findBestMigrationHost(
+                    foundHostData.clusterid,
+                    hostname,
+                    vm.memory,
+                    busyHosts,
+                    capacity)
+                if not migrationHost:
+                    # Running migrations may free up a host
+                    if len(inflight) > 0:
+                        break
+                    print "\nError: No hosts with enough capacity to migrate vm's to. Please migrate manually to another cluster."
+                    sys.exit(1)
+                pending.pop(0)
+                capacity.place(migrationHost.name, vm.memory)
+                sys.stdout.write(vm.name + ", ")
+                sys.stdout.flush()
+                if self.DEBUG == 1:
+                    print "Debug: Migrating vm to host '" + migrationHost.name + "'.."
+
+                jobid = self._startMigration(vm, migrationHost)
+                if jobid == 1:
+                    if not self._migrateViaXapi(vm, hostname, migrationHost):
+                        return False
                     continue
-                for vm in vmdata:
-                    sys.stdout.write(vm.name + ", ")
-                    sys.stdout.flush()
-                    vmresult = 1
-                    if self.DRYRUN == 0:
-                        migrationHost = self.findBestMigrationHost(
-                            foundHostData.clusterid,
-                            hostname,
-                            vm.memory)
-                        if not migrationHost:
-                            print "\nError: No hosts with enough capacity to migrate vm's to. Please migrate manually to another cluster."
-                            sys.exit(1)
-                        try:
-                            if self.DEBUG == 1:
-                                print "Debug: Migrating vm to host '" + migrationHost.name + "'.."
-
-                            # Systemvm or instance
-                            if bool(re.search('[rvs]-([\d])*-VM', vm.name)):
-                                vmresult = self.migrateSystemVm(
-                                    vm.id,
-                                    migrationHost.id)
-                                instance = vm.name
-                            else:
-                                vmresult = self.migrateVirtualMachine(
-                                    vm.id,
-                                    migrationHost.id)
-                                instance = vm.instancename
-                        except:
-                            vmresult = 1
-
-                        try:
-                            # Parse result
-                            if vmresult is None or vmresult == 1:
-                                sys.stdout.write(
-                                    vm.name +
-                                    " (failed using CloudStack, trying XAPI " +
-                                    instance +
-                                    "..), ")
-                                sys.stdout.flush()
-                                xapiresult, xapioutput = self.ssh.migrateVirtualMachineViaXapi(
-                                    {'hostname': hostname, 'desthostname': migrationHost.name, 'vmname': instance})
-                                if self.DEBUG == 1:
-                                    print "Debug: Output: " + str(xapioutput) + " code " + str(xapiresult)
-                            elif self.DEBUG == 1:
-                                print "Debug: VM " + vm.name + " migrated OK"
-                        except:
-                            vmresult = 1
-                        if vmresult == 1:
-                            sys.stdout.write(
-                                vm.name +
-                                " (failed using CloudStack and XAPI!), ")
-                            sys.stdout.flush()
-                            return False
+                inflight[jobid] = (vm, migrationHost, time.time())
+                perDestination[migrationHost.name] = perDestination.get(
+                    migrationHost.name, 0) + 1
+
+            if len(inflight) == 0:
+                continue
+            time.sleep(5)
+
+            # Check on all running migrations at once
+            for jobid in inflight.keys():
+                vm, migrationHost, started = inflight[jobid]
+                jobresult = self.queryAsyncJobResult(jobid)
+                if jobresult == 1 or jobresult is None or jobresult.jobstatus == 0:
+                    if time.time() - started < self.cloudstack.asyncTimeout:
+                        continue
+                    print "\nWarning: Migration of " + vm.name + " timed out"
+                    jobstatus = 2
+                else:
+                    jobstatus = jobresult.jobstatus
+                del inflight[jobid]
+                perDestination[migrationHost.name] -= 1
+
+                if jobstatus == 1:
+                    if self.DEBUG == 1:
+                        print "Debug: VM " + vm.name + " migrated OK"
+                elif not self._migrateViaXapi(vm, hostname, migrationHost):
+                    return False
         return True
 
+    # Start migrating a vm, returns the id of the async job
+    def _startMigration(self, vm, migrationHost):
+        # Systemvm or instance
+        if bool(re.search('[rvs]-([\d])*-VM', vm.name)):
+            apicall = migrateSystemVm.migrateSystemVmCmd()
+        else:
+            apicall = migrateVirtualMachine.migrateVirtualMachineCmd()
+        apicall.virtualmachineid = str(vm.id)
+        apicall.hostid = str(migrationHost.id)
+
+        # Return right after the job was submitted, we poll it ourselves
+        apicall.isAsync = "false"
+        data = self._callAPI(apicall)
+        if data is None or data == 1 or data.jobid is None:
+            return 1
+        return data.jobid
+
+    # Migrate a vm using XAPI, when CloudStack failed to do so
+    def _migrateViaXapi(self, vm, hostname, migrationHost):
+        # Systemvm or instance
+        if bool(re.search('[rvs]-([\d])*-VM', vm.name)):
+            instance = vm.name
+        else:
+            instance = vm.instancename
+        try:
+            sys.stdout.write(
+                vm.name +
+                " (failed using CloudStack, trying XAPI " +
+                instance +
+                "..), ")
+            sys.stdout.flush()
+            xapiresult, xapioutput = self.ssh.migrateVirtualMachineViaXapi(
+                {'hostname': hostname, 'desthostname': migrationHost.name, 'vmname': instance})
+            if self.DEBUG == 1:
+                print "Debug: Output: " + str(xapioutput) + " code " + str(xapiresult)
+            if xapiresult == 0:
+                return True
+        except:
+            pass
+        sys.stdout.write(
+            vm.name +
+            " (failed using CloudStack and XAPI!), ")
+        sys.stdout.flush()
+        return False
+
+    # Get the status of an async job
+    def queryAsyncJobResult(self, jobid):
+        apicall = queryAsyncJobResult.queryAsyncJobResultCmd()
+        apicall.jobid = str(jobid)
+
+        # Call CloudStack API
+        return self._callAPI(apicall)
+
     # list oscategories
     def listOsCategories(self,args):
       args = self.remove_empty_values(args)
@@ -25,34 +25,133 @@ from cloudstackopsbase import *
 # Import our dependencies
 import subprocess
 from subprocess import Popen, PIPE
+import tempfile
+import shutil
+import atexit
+import select
 
 
 class CloudStackOpsSSH(CloudStackOpsBase):
 
-    # Run SSH remoteCmd
-    def runSSHCommand(self, hostname, remoteCmd):
-        if self.DEBUG == 1:
-            print "Debug: Running SSH command on " + hostname + " :" + remoteCmd
-        p = subprocess.Popen(['ssh',
-                              '-oStrictHostKeyChecking=no',
-                              '-oUserKnownHostsFile=/dev/null',
-                              '-q',
-                              'root@' + hostname,
-                              remoteCmd],
-                             stdout=subprocess.PIPE)
-        output = ""
+    # Init function. With multiplex enabled, commands to the same hypervisor
+    # share one SSH connection (OpenSSH ControlMaster) instead of doing a
+    # full handshake each time.
+    def __init__(self, debug=0, dryrun=0, force=0, multiplex=True):
+        super(CloudStackOpsSSH, self).__init__(debug, dryrun, force)
+        self.multiplex = multiplex
+        self.controlPersist = 300
+        self.controlDir = None
+        if multiplex:
+            # Unix socket paths are limited to 104 bytes on macOS, where
+            # $TMPDIR alone is about half of that
+            self.controlDir = tempfile.mkdtemp(prefix='csops-', dir='/tmp')
+        self.controlHosts = set()
+        self.sshTimeout = None
+        atexit.register(self.closeSSHConnections)
+
+    # The ssh command line to run remoteCmd on a host
+    def _sshCommand(self, hostname, remoteCmd):
+        command = ['ssh',
+                   '-oStrictHostKeyChecking=no',
+                   '-oUserKnownHostsFile=/dev/null',
+                   '-q']
+        if self.controlDir is not None:
+            self.controlHosts.add(hostname)
+            command += ['-oControlMaster=auto',
+                        '-oControlPath=' + self.controlDir + '/%C',
+                        '-oControlPersist=' + str(self.controlPersist)]
+        return command + ['root@' + hostname, remoteCmd]
+
+    # Stop the shared SSH connections
+    def closeSSHConnections(self):
+        if self.controlDir is None:
+            return
+        for hostname in self.controlHosts:
+            subprocess.call(['ssh',
+                             '-q',
+                             '-oControlPath=' + self.controlDir + '/%C',
+                             '-O', 'exit',
+                             'root@' + hostname],
+                            stdout=open(os.devnull, 'w'),
+                            stderr=subprocess.STDOUT)
+        shutil.rmtree(self.controlDir, True)
+        self.controlDir = None
+        self.controlHosts = set()
+
+    # Run a command, reading its stdout and stderr as they come in. Returns
+    # the return code (124 when it was killed after timeout seconds), stdout
+    # and stderr.
+    def _runCommand(self, command, timeout=None):
+        p = subprocess.Popen(command,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             close_fds=True)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        output = {p.stdout: [], p.stderr: []}
+        streams = [p.stdout, p.stderr]
+        timedOut = False
         try:
-            output = p.stdout.read().strip()
-            while p.poll() is None:
-                time.sleep(0.5)
+            while len(streams) > 0:
+                wait = 5
+                # Once stdout is done the command is about to exit. Check on
+                # it often, as a daemonized child (like a ssh ControlMaster)
+                # may keep stderr open after the command itself is done.
+                if p.stdout not in streams:
+                    wait = 0.1
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        timedOut = True
+                        break
+                ready = select.select(streams, [], [], wait)[0]
+                if len(ready) == 0:
+                    if p.poll() is not None:
+                        break
+                    continue
+                for stream in ready:
+                    data = os.read(stream.fileno(), 4096)
+                    if data == "":
+                        streams.remove(stream)
+                    else:
+                        output[stream].append(data)
         except:
-            pass
-        retcode = self.__parseReturnCode(p.returncode, hostname)
+            timedOut = p.poll() is None
+
+        if timedOut:
+            p.kill()
+        retcode = p.wait()
+        p.stdout.close()
+        p.stderr.close()
+        if timedOut:
+            retcode = 124
+        return retcode, "".join(output[p.stdout]), "".join(output[p.stderr])
+
+    # Run SSH remoteCmd, optionally giving up after timeout seconds
+    def runSSHCommand(self, hostname, remoteCmd, timeout=None):
+        retcode, output, stderr = self.runSSHCommandWithStderr(hostname, remoteCmd, timeout)
         return retcode, output
 
-    def __parseReturnCode(self, retcode, hostname):
-        if retcode != 0:
+    # Run SSH remoteCmd, also returning what it wrote to stderr
+    def runSSHCommandWithStderr(self, hostname, remoteCmd, timeout=None):
+        if self.DEBUG == 1:
+            print "Debug: Running SSH command on " + hostname + " :" + remoteCmd
+        if timeout is None:
+            timeout = self.sshTimeout
+        retcode, output, stderr = self._runCommand(
+            self._sshCommand(hostname, remoteCmd), timeout)
+        retcode = self.__parseReturnCode(retcode, hostname, stderr, timeout)
+        return retcode, output.strip(), stderr
+
+    def __parseReturnCode(self, retcode, hostname, stderr='', timeout=None):
+        if retcode == 124 and timeout is not None:
+            print "Error: SSH command on '" + hostname + "' did not finish within " + str(timeout) + " seconds"
+        elif retcode != 0:
             print "Error: SSH connection to '" + hostname + "' returned code " + str(retcode)
+            if len(stderr.strip()) > 0:
+                print "Error: " + stderr.strip()
             print "Note: Please make sure 'ssh root@" + hostname + "' works key-based and try again."
         elif self.DEBUG == 1:
             print "Note: SSH remoteCmd executed OK."
@@ -91,7 +190,7 @@ class CloudStackOpsSSH(CloudStackOpsBase):
                      params=name-label,memory-static-max is-control-domain=false | \
                      tr '\\n' ' ' | sed 's/name-label/\\n/g' | \
                      awk {'print $4 \",\" $8'} | sed '/^,$/d'| wc -l"
-        return self.runSSHCommand(hostname, remoteCmd)
+        return self.runSSHCommand(hostname, remoteCmd, 60)
 
     # Migrate vm via xapi
     def migrateVirtualMachineViaXapi(self, args):
@@ -105,23 +204,13 @@ class CloudStackOpsSSH(CloudStackOpsBase):
             remoteCmd = "xe vm-migrate vm=" + vmname + " host=" + desthostname
             if self.DEBUG == 1:
                 print "Debug: Running SSH command on " + hostname + " :" + remoteCmd
-            p = subprocess.Popen(['ssh',
-                                  '-oStrictHostKeyChecking=no',
-                                  '-oUserKnownHostsFile=/dev/null',
-                                  '-q',
-                                  'root@' + hostname,
-                                  remoteCmd],
-                                 stdout=subprocess.PIPE)
-            output = ""
-            try:
-                output = p.stdout.read().strip()
-                while p.poll() is None:
-                    time.sleep(0.5)
-            except:
-                pass
-            retcode = p.returncode
+            retcode, output, stderr = self._runCommand(
+                self._sshCommand(hostname, remoteCmd))
+            output = output.strip()
             if retcode != 0:
                 print "Error: something went wrong on host " + hostname + ". Got return code " + str(retcode)
+                if len(stderr.strip()) > 0:
+                    print "Error: " + stderr.strip()
             elif self.DEBUG == 1:
                 print "Note: Output: " + output
             return retcode, output
@@ -0,0 +1,472 @@
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Class to keep a local inventory snapshot of CloudStack in SQLite
+# Remi Bergsma - rbergsma@schubergphilis.com
+
+# Import the class we depend on
+from cloudstackopsbase import *
+# Import our dependencies
+import sqlite3
+import json
+import threading
+from marvin.cloudstackAPI import *
+from marvin.jsonHelper import jsonLoader, jsonDump
+
+
+class CloudStackSnapshot(CloudStackOpsBase):
+
+    # Object types in a snapshot: table, the list call that fills it and
+    # answers from it, and the columns we index and filter on
+    snapshotTypes = [
+        ('zones', 'listZones', ['name']),
+        ('pods', 'listPods', ['name', 'zoneid']),
+        ('clusters', 'listClusters',
+         ['name', 'zoneid', 'podid', 'allocationstate', 'managedstate',
+          'clustertype', 'hypervisor']),
+        ('hosts', 'listHosts',
+         ['name', 'zoneid', 'podid', 'clusterid', 'resourcestate', 'state',
+          'type']),
+        ('storagepools', 'listStoragePools',
+         ['name', 'zoneid', 'podid', 'clusterid', 'ipaddress', 'path']),
+        ('serviceofferings', 'listServiceOfferings',
+         ['name', 'issystem', 'systemvmtype']),
+        ('domains', 'listDomains', ['name', 'level']),
+        ('virtualmachines', 'listVirtualMachines',
+         ['name', 'instancename', 'zoneid', 'podid', 'clusterid', 'hostid',
+          'domainid', 'projectid', 'state', 'templateid']),
+        ('routers', 'listRouters',
+         ['name', 'zoneid', 'podid', 'clusterid', 'hostid', 'domainid',
+          'projectid', 'state', 'requiresupgrade', 'vpcid']),
+        ('systemvms', 'listSystemVms',
+         ['name', 'zoneid', 'podid', 'clusterid', 'hostid', 'state',
+          'systemvmtype']),
+        ('volumes', 'listVolumes',
+         ['name', 'zoneid', 'podid', 'clusterid', 'storageid',
+          'virtualmachineid', 'domainid', 'projectid', 'type', 'state']),
+    ]
+
+    # Filters the API applies when they are not specified
+    defaultFilters = {
+        'serviceofferings': {'issystem': 'false'},
+    }
+
+    # Async job instance types and the table their objects are stored in
+    jobInstanceTypes = {
+        'VirtualMachine': 'virtualmachines',
+        'DomainRouter': 'routers',
+        'SystemVm': 'systemvms',
+        'Volume': 'volumes',
+        'Host': 'hosts',
+        'StoragePool': 'storagepools',
+    }
+
+    # Finished async jobs are purged by CloudStack (job.expire.minutes), so
+    # older snapshots cannot be refreshed reliably
+    maxRefreshAge = 12 * 3600
+
+    # Parameters that do not filter the result
+    ignoredParams = ['listall', 'page', 'pagesize', 'isasync', 'required']
+
+    # Init function
+    def __init__(self, debug=0, dryrun=0, force=0):
+        super(CloudStackSnapshot, self).__init__(debug, dryrun, force)
+        self.conn = None
+        self.filename = ''
+        self.lock = threading.Lock()
+
+    # Open an existing snapshot
+    def openSnapshot(self, filename):
+        if not os.path.isfile(filename):
+            print "Error: Snapshot file '" + filename + "' does not exist. Create it with snapshotInventory.py first."
+            return 1
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.filename = filename
+        if self.DEBUG == 1:
+            print "Debug: Using snapshot '" + filename + "' last synced " + str(self.getInfo('synced'))
+        return 0
+
+    # Close the snapshot
+    def closeSnapshot(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # Create the tables and indexes
+    def _createTables(self):
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS snapshot_info \
+        (key TEXT PRIMARY KEY, value TEXT)")
+        for table, listCall, columns in self.snapshotTypes:
+            cursor.execute("CREATE TABLE IF NOT EXISTS " + table + " \
+            (id TEXT PRIMARY KEY, " +
+                           ", ".join([column + " TEXT" for column in columns]) +
+                           ", data TEXT)")
+            for column in columns:
+                cursor.execute("CREATE INDEX IF NOT EXISTS " + table + "_" +
+                               column + " ON " + table + " (" + column + ")")
+        self.conn.commit()
+        cursor.close()
+
+    # Get a value from the snapshot_info table
+    def getInfo(self, key):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT value FROM snapshot_info WHERE key = ?", (key,))
+            result = cursor.fetchone()
+            cursor.close()
+        if result is None:
+            return None
+        return result[0]
+
+    # Set a value in the snapshot_info table
+    def setInfo(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO snapshot_info (key, value) VALUES (?, ?)",
+                (key, str(value)))
+            self.conn.commit()
+
+    # Convert a value to the way we store it
+    def _toColumn(self, value):
+        if value is None:
+            return None
+        if value is True:
+            return 'true'
+        if value is False:
+            return 'false'
+        return unicode(value)
+
+    # Get the table definition that belongs to a list call
+    def _getType(self, listCall):
+        for table, call, columns in self.snapshotTypes:
+            if call == listCall:
+                return table, columns
+        return None, None
+
+    # Store objects returned by a list call. Missing pod and cluster
+    # columns are looked up from the host or storage pool of the object.
+    def storeObjects(self, table, objects, hosts={}, storagepools={}):
+        if objects is None or objects == 1:
+            return 0
+        for t, listCall, tableColumns in self.snapshotTypes:
+            if t == table:
+                columns = tableColumns
+
+        storagepoolsByName = {}
+        for pool in storagepools.values():
+            storagepoolsByName[pool.name] = pool
+
+        rows = []
+        for o in objects:
+            values = {}
+            for column in columns:
+                values[column] = getattr(o, column)
+            if values.get('storageid', False) is None and o.storage is not None:
+                if o.storage in storagepoolsByName:
+                    values['storageid'] = storagepoolsByName[o.storage].id
+            parent = None
+            if values.get('hostid') in hosts:
+                parent = hosts[values['hostid']]
+            elif values.get('storageid') in storagepools:
+                parent = storagepools[values['storageid']]
+            if parent is not None:
+                for column in ['podid', 'clusterid']:
+                    if column in values and values[column] is None:
+                        values[column] = getattr(parent, column)
+            rows.append([self._toColumn(o.id)] +
+                        [self._toColumn(values[column]) for column in columns] +
+                        [json.dumps(jsonDump.dump(o))])
+
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO " + table +
+                                  " (id, " + ", ".join(columns) + ", data) VALUES (" +
+                                  ", ".join(["?"] * (len(columns) + 2)) + ")", rows)
+            self.conn.commit()
+        return len(rows)
+
+    # Fetch everything from the CloudStack API into a new snapshot file
+    def createSnapshot(self, filename, ops):
+        tmpfile = filename + ".tmp"
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+        self.conn = sqlite3.connect(tmpfile, check_same_thread=False)
+        self._createTables()
+
+        # Look at the jobs before fetching, so a refresh does not miss
+        # changes made while we are busy
+        jobs = self._listAsyncJobs(ops)
+        if jobs == 1:
+            print "Error: Fetching async jobs failed, not creating snapshot."
+            self.closeSnapshot()
+            os.remove(tmpfile)
+            return 1
+        watermark = self._getWatermark(jobs, None)
+
+        counts = {}
+        hosts = {}
+        storagepools = {}
+        for table, listCall, columns in self.snapshotTypes:
+            print "Note: Fetching " + table + ".."
+            counts[table] = 0
+            for apicall in self._getSnapshotCalls(listCall):
+                objects = ops._callAPI(apicall)
+                if objects == 1:
+                    print "Error: Fetching " + table + " failed, not creating snapshot."
+                    self.closeSnapshot()
+                    os.remove(tmpfile)
+                    return 1
+                if objects is None:
+                    continue
+                if table == 'hosts':
+                    for h in objects:
+                        hosts[h.id] = h
+                elif table == 'storagepools':
+                    for p in objects:
+                        storagepools[p.id] = p
+                counts[table] += self.storeObjects(
+                    table, objects, hosts, storagepools)
+
+        self.setInfo('created', time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.setInfo('synced', time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.setInfo('synced_epoch', int(time.time()))
+        self.setInfo('cloud', ops.getCloudName())
+        if watermark is not None:
+            self.setInfo('watermark', watermark)
+        self.closeSnapshot()
+        os.rename(tmpfile, filename)
+        self.openSnapshot(filename)
+        return counts
+
+    # Update only the objects touched by async jobs since the last sync.
+    # Returns 1 when that is not possible and a full snapshot is needed.
+    def refreshSnapshot(self, ops):
+        syncedEpoch = self.getInfo('synced_epoch')
+        if syncedEpoch is None or time.time() - int(syncedEpoch) > self.maxRefreshAge:
+            print "Warning: Snapshot is too old to refresh, async jobs may have been purged since."
+            return 1
+        if self.getInfo('cloud') != ops.getCloudName():
+            print "Warning: Snapshot was made of another cloud (" + str(self.getInfo('cloud')) + ")."
+            return 1
+
+        watermark = self.getInfo('watermark')
+        jobs = self._listAsyncJobs(ops, watermark)
+        if jobs == 1:
+            print "Error: Fetching async jobs failed."
+            return 1
+        newWatermark = self._getWatermark(jobs, watermark)
+
+        # Objects touched by the jobs, per table
+        changed = {}
+        for job in jobs:
+            table = self.jobInstanceTypes.get(job.jobinstancetype)
+            if table is None or job.jobinstanceid is None:
+                continue
+            if table not in changed:
+                changed[table] = []
+            if job.jobinstanceid not in changed[table]:
+                changed[table].append(job.jobinstanceid)
+
+        hosts = self._loadObjects('hosts')
+        storagepools = self._loadObjects('storagepools')
+
+        counts = {}
+        for table, listCall, columns in self.snapshotTypes:
+            counts[table] = 0
+            if table not in changed:
+                continue
+            for objectid in changed[table]:
+                objects = self._fetchObject(ops, listCall, 'id', objectid)
+                if objects == 1:
+                    return 1
+                self.deleteObjects(table, 'id', objectid)
+                if objects is not None:
+                    if table == 'hosts':
+                        hosts[objectid] = objects[0]
+                    elif table == 'storagepools':
+                        storagepools[objectid] = objects[0]
+                    self.storeObjects(table, objects, hosts, storagepools)
+                counts[table] += 1
+
+                # Deploying or expunging a vm also changes its volumes
+                if table == 'virtualmachines':
+                    volumes = self._fetchObject(
+                        ops, 'listVolumes', 'virtualmachineid', objectid)
+                    if volumes == 1:
+                        return 1
+                    self.deleteObjects('volumes', 'virtualmachineid', objectid)
+                    self.storeObjects('volumes', volumes, hosts, storagepools)
+
+        if newWatermark is not None:
+            self.setInfo('watermark', newWatermark)
+        self.setInfo('synced', time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.setInfo('synced_epoch', int(time.time()))
+        return counts
+
+    # Delete objects from a table
+    def deleteObjects(self, table, column, value):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM " + table + " WHERE " + column + " = ?", (value,))
+            self.conn.commit()
+
+    # Load all objects of a table, by id
+    def _loadObjects(self, table):
+        objects = {}
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT id, data FROM " + table)
+            result = cursor.fetchall()
+            cursor.close()
+        for objectid, data in result:
+            objects[objectid] = jsonLoader(json.loads(data))
+        return objects
+
+    # Fetch the objects of a type matching a filter from the API
+    def _fetchObject(self, ops, listCall, param, value):
+        for apicall in self._getSnapshotCalls(listCall):
+            setattr(apicall, param, value)
+            objects = ops._callAPI(apicall)
+            if objects is not None:
+                return objects
+        return None
+
+    # List async jobs of all accounts, optionally since a start date
+    def _listAsyncJobs(self, ops, startdate=None):
+        apicall = listAsyncJobs.listAsyncJobsCmd()
+        apicall.listAll = "true"
+        apicall.startdate = startdate
+        jobs = ops._callAPI(apicall)
+        if jobs is None:
+            return []
+        return jobs
+
+    # The next refresh starts at the oldest unfinished job, so we see it
+    # again when it is done, or else at the newest job
+    # The created date of a job (2015-06-01T12:00:00+0200) is used as the
+    # startdate as is, the API parses it with its time zone
+    def _getWatermark(self, jobs, watermark):
+        pending = [job.created for job in jobs if job.jobstatus == 0]
+        if len(pending) > 0:
+            return min(pending)
+        if len(jobs) > 0:
+            return max([job.created for job in jobs])
+        return watermark
+
+    # The list calls needed to fetch all objects of a type
+    def _getSnapshotCalls(self, listCall):
+        apicall = getattr(globals()[listCall], listCall + "Cmd")()
+        if hasattr(apicall, 'listall'):
+            apicall.listAll = "true"
+        if listCall == 'listServiceOfferings':
+            systemcall = listServiceOfferings.listServiceOfferingsCmd()
+            systemcall.issystem = "true"
+            return [apicall, systemcall]
+        if hasattr(apicall, 'projectid'):
+            projectcall = getattr(globals()[listCall], listCall + "Cmd")()
+            projectcall.listAll = "true"
+            projectcall.projectid = "-1"
+            return [apicall, projectcall]
+        return [apicall]
+
+    # Answer a list call from the snapshot. Returns False when the snapshot
+    # cannot answer it, so the caller can ask the API instead.
+    def query(self, apicall):
+        if self.conn is None:
+            return False
+        table, columns = self._getType(
+            apicall.__class__.__name__.replace("Cmd", ""))
+        if table is None:
+            return False
+
+        # Only filter on parameters the API call knows, like the API does
+        knownParams = apicall.__class__().__dict__.keys()
+        filters = dict(self.defaultFilters.get(table, {}))
+        listAll = 'false'
+        keyword = None
+        projectid = None
+        for param, value in apicall.__dict__.items():
+            if value is None or value == [] or value == '':
+                continue
+            p = param.lower()
+            if p == 'listall':
+                listAll = str(value).lower()
+            elif p in self.ignoredParams:
+                continue
+            elif p == 'isrecursive':
+                # The snapshot does not know the domain tree
+                if self.DEBUG == 1:
+                    print "Debug: Snapshot cannot answer recursive domain calls, asking the API"
+                return False
+            elif p == 'keyword':
+                keyword = str(value)
+            elif p == 'projectid':
+                projectid = str(value)
+            elif param not in knownParams:
+                continue
+            elif p == 'id' or p in columns:
+                filters[p] = self._toColumn(value)
+            else:
+                if self.DEBUG == 1:
+                    print "Debug: Snapshot cannot filter " + table + " on " + p + ", asking the API"
+                return False
+
+        # Account owned objects are only all returned with listAll
+        if 'domainid' in columns and listAll != 'true':
+            return False
+
+        where = []
+        values = []
+        for column, value in filters.items():
+            where.append(column + " = ?")
+            values.append(value)
+        if 'projectid' in columns:
+            if projectid is None:
+                where.append("projectid IS NULL")
+            elif projectid == '-1':
+                where.append("projectid IS NOT NULL")
+            else:
+                where.append("projectid = ?")
+                values.append(projectid)
+        if keyword is not None:
+            if 'instancename' in columns:
+                where.append("(name LIKE ? OR instancename LIKE ?)")
+                values += ['%' + keyword + '%', '%' + keyword + '%']
+            else:
+                where.append("name LIKE ?")
+                values.append('%' + keyword + '%')
+
+        sql = "SELECT data FROM " + table
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY rowid"
+
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(sql, values)
+            result = cursor.fetchall()
+            cursor.close()
+
+        if self.DEBUG == 1:
+            print "Debug: Snapshot answered " + apicall.__class__.__name__ + " with " + str(len(result)) + " objects"
+
+        if len(result) == 0:
+            return None
+        return [jsonLoader(json.loads(row[0])) for row in result]
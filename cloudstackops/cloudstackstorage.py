@@ -32,6 +32,7 @@ from cloudstackopsbase import *
 from fabric import *
 from fabric import api as fab
 from fabric.api import run, env, prefix, output, settings
+from fabric.state import connections
 
 
 class StorageHelper():
@@ -148,27 +149,43 @@ class StorageHelper():
 
         return mountpoint
 
-    # returns a dict of remote files and size (mb) for a given hostname and
-    # path
+    # yields (path, size in bytes) of the remote files below a path on a given
+    # hostname, line by line while find is still running on the remote host.
+    # Raises IOError when the list is incomplete.
     def list_files(self, hostname, path):
 
-        file_list = {}
+        if path is None or path == '':
+            return
 
-        if path is not '':
-            remote_cmd = "find -H " + path + " -type f -exec du -sm {} \;"
-            returncode, output, errmsg = self._remote_cmd(hostname, remote_cmd)
+        # one find for all files, %b is the disk usage in 512 byte blocks like du
+        remote_cmd = "find -H " + path + " -type f -printf '%b\\t%p\\n' 2>/dev/null"
 
-            if returncode == 0:
+        if self.debug > 0:
+            print "[DEBUG]: Running remote command: ", remote_cmd, " on", env.user + "@" + hostname
+
+        channel = None
+        try:
+            channel = connections[env.user + "@" + hostname].get_transport().open_session()
+            channel.exec_command(remote_cmd)
 
-                for line in output.split('\r\n'):
-                    line = line.split('\t')
+            for line in channel.makefile('rb', 1024 * 1024):
+                line = line.rstrip('\n').split('\t', 1)
 
-                    file_size = line[0]
+                if len(line) == 2:
+                    file_size = int(line[0]) * 512
                     file_path = line[1]
 
-                    file_list[file_path] = file_size
+                    yield file_path, file_size
+
+            returncode = channel.recv_exit_status()
 
-            else:
-                print "[ERROR]: Failed to retrieve list from " + hostname + "of file due to: ", output, errmsg
+        except Exception as error:
+            raise IOError("Failed to retrieve list of files from " + hostname + " due to: " + str(error))
+
+        finally:
+            if channel is not None:
+                channel.close()
 
-        return file_list
+        if returncode != 0:
+            raise IOError("Failed to retrieve complete list of files from " + hostname +
+                          ", find returned " + str(returncode))
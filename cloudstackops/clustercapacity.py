@@ -0,0 +1,90 @@
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Model of the free memory of the hosts in a cluster, used to place vm's
+# Remi Bergsma - rbergsma@schubergphilis.com
+
+# Import our dependencies
+import heapq
+
+
+class ClusterCapacity(object):
+
+    # Keep this much memory free on a host (in bytes)
+    minFreeMemory = 10 * 1024 * 1024 * 1024
+
+    # Init function, with the hosts from listHosts
+    def __init__(self, hosts, debug=0):
+        self.DEBUG = debug
+        self.hosts = {}
+        self.freeMemory = {}
+        self.heap = []
+        for h in hosts:
+            # Only hosts that have enough resources
+            if h.suitableformigration == False:
+                continue
+            # And are not in Maintenance, Error or Disabled
+            if h.resourcestate == "Disabled" or h.resourcestate == "Maintenance" or h.resourcestate == "Error":
+                continue
+            self.hosts[h.name] = h
+            self._setFreeMemory(h.name, h.memorytotal - h.memoryallocated)
+
+    # Store the free memory of a host and (re)add it to the heap. Older heap
+    # entries of the host are skipped when we come across them.
+    def _setFreeMemory(self, hostname, memory):
+        self.freeMemory[hostname] = memory
+        heapq.heappush(self.heap, (-memory, hostname))
+
+    # Find the host with most free memory that fits the vm (memory in MB)
+    def findHost(self, requestedMemory, skipHostnames=[]):
+        if requestedMemory is None:
+            requestedMemory = 0
+        requiredMemory = max(self.minFreeMemory, requestedMemory * 1024 * 1024)
+
+        migrationHost = False
+        skipped = []
+        while len(self.heap) > 0:
+            memory, hostname = heapq.heappop(self.heap)
+            memory = -memory
+            # Outdated entry
+            if self.freeMemory.get(hostname) != memory:
+                continue
+            skipped.append((-memory, hostname))
+            if hostname in skipHostnames:
+                continue
+            # The host with most free memory does not fit, so no host does
+            if memory < requiredMemory:
+                if self.DEBUG == 1:
+                    print "Warning: No host has enough memory, best is " + hostname + " with free mem: " + str(memory)
+                break
+            if self.DEBUG == 1:
+                print "Note: Found migration host '" + hostname + "' with free memory: " + str(memory)
+            migrationHost = self.hosts[hostname]
+            break
+
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return migrationHost
+
+    # Account for a vm placed on a host (memory in MB)
+    def place(self, hostname, requestedMemory):
+        if hostname not in self.freeMemory or requestedMemory is None:
+            return
+        self._setFreeMemory(hostname, self.freeMemory[
+                            hostname] - requestedMemory * 1024 * 1024)
@@ -0,0 +1,285 @@
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Talk XAPI (XML-RPC) to XenServer pools, instead of running xe over SSH
+# Remi Bergsma - rbergsma@schubergphilis.com
+
+# Import our dependencies
+import xmlrpclib
+import ssl
+import threading
+import time
+import atexit
+
+
+# HTTPS transport that does not hang forever on an unresponsive host
+class TimeoutSafeTransport(xmlrpclib.SafeTransport):
+
+    def __init__(self, timeout, **kwargs):
+        xmlrpclib.SafeTransport.__init__(self, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = xmlrpclib.SafeTransport.make_connection(self, host)
+        conn.timeout = self.timeout
+        return conn
+
+
+# XAPI failure, with the error description XenServer returned
+class XapiError(Exception):
+
+    def __init__(self, details):
+        Exception.__init__(self, str(details))
+        self.details = details
+
+
+class XapiClient(object):
+
+    # Sessions per pool master address, and the pool master of each host
+    # address we talked to. Shared, so all users log in once per pool.
+    sessions = {}
+    masters = {}
+    # Addresses we could not log in to, and until when we leave them alone
+    unavailable = {}
+    lock = threading.Lock()
+    logoutRegistered = False
+
+    def __init__(self, user='root', password=None, timeout=30, debug=0, retryAfter=60):
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.DEBUG = debug
+        self.retryAfter = retryAfter
+        # XAPI limits the sessions per user, so do not leave ours behind
+        if not XapiClient.logoutRegistered:
+            XapiClient.logoutRegistered = True
+            atexit.register(self.logout)
+
+    # Proxy to the XAPI of an address
+    def _getProxy(self, address):
+        kwargs = {}
+        # XenServer uses self-signed certificates
+        if hasattr(ssl, '_create_unverified_context'):
+            kwargs['context'] = ssl._create_unverified_context()
+        return xmlrpclib.ServerProxy(
+            "https://" + address,
+            transport=TimeoutSafeTransport(self.timeout, **kwargs),
+            allow_none=True)
+
+    # Unpack a XAPI result, raising its error description on failure
+    def _result(self, result):
+        if result['Status'] == 'Success':
+            return result.get('Value')
+        raise XapiError(result.get('ErrorDescription'))
+
+    # Login to the pool of a host, following it to the pool master
+    def _login(self, address):
+        for attempt in range(2):
+            proxy = self._getProxy(address)
+            try:
+                session = self._result(proxy.session.login_with_password(
+                    self.user, self.password))
+                return address, proxy, session
+            except XapiError, e:
+                # Slaves tell us who their master is
+                if e.details and e.details[0] == 'HOST_IS_SLAVE':
+                    address = e.details[1]
+                    continue
+                raise
+        raise XapiError(['HOST_IS_SLAVE', address])
+
+    # Remember that XAPI of an address cannot be used, so we do not wait for
+    # it on every call. Wrong credentials will not get better during a run.
+    def _markUnavailable(self, address, error):
+        if isinstance(error, XapiError) and error.details and \
+                error.details[0] == 'SESSION_AUTHENTICATION_FAILED':
+            until = float('inf')
+            print "Warning: XAPI login to " + address + " failed, check xapi_user and xapi_password " \
+                  "in the [xenserver] section of the config file. Using SSH instead."
+        else:
+            until = time.time() + self.retryAfter
+            print "Warning: XAPI of " + address + " is not reachable (" + str(error) + "), using SSH " \
+                  "instead for the next " + str(self.retryAfter) + "s."
+        with self.lock:
+            self.unavailable[address] = until
+
+    # Get the cached session of the pool a host address belongs to. Also
+    # returns whether the session was cached.
+    def _getSession(self, address):
+        with self.lock:
+            master = self.masters.get(address, address)
+            if master in self.sessions:
+                return master, self.sessions[master], True
+            if self.unavailable.get(address, 0) > time.time():
+                raise XapiError(['XAPI_UNAVAILABLE', address])
+        try:
+            master, proxy, session = self._login(address)
+        except Exception, e:
+            self._markUnavailable(address, e)
+            raise XapiError(['XAPI_UNAVAILABLE', address])
+        if self.DEBUG == 1:
+            print "Debug: Logged in to XAPI of pool master " + master
+        with self.lock:
+            self.unavailable.pop(address, None)
+            self.masters[address] = master
+            self.sessions[master] = (proxy, session)
+        return master, (proxy, session), False
+
+    # Forget the session of a pool, for example when its master rebooted
+    def _dropSession(self, master):
+        with self.lock:
+            self.sessions.pop(master, None)
+            for address in self.masters.keys():
+                if self.masters[address] == master:
+                    del self.masters[address]
+
+    # Log out of all sessions we have
+    def logout(self):
+        with self.lock:
+            sessions = self.sessions.items()
+            self.sessions.clear()
+            self.masters.clear()
+        for master, (proxy, session) in sessions:
+            try:
+                proxy.session.logout(session)
+                if self.DEBUG == 1:
+                    print "Debug: Logged out of XAPI of pool master " + master
+            except Exception, e:
+                if self.DEBUG == 1:
+                    print "Debug: XAPI logout on " + master + " failed: " + str(e)
+
+    # Forget all sessions without using them, for use in a forked process
+    # so it does not talk over the connections of its parent
+    def forgetSessions(self):
+        with self.lock:
+            self.sessions.clear()
+            self.masters.clear()
+
+    # Call a XAPI method (like 'VM.get_all_records') on the pool of a host
+    # address. Returns None when XAPI could not be used.
+    def call(self, address, method, *args):
+        # Without credentials we do not even try
+        if not self.password:
+            return None
+        for attempt in range(2):
+            master = address
+            cached = False
+            try:
+                master, (proxy, session), cached = self._getSession(address)
+                function = proxy
+                for name in method.split('.'):
+                    function = getattr(function, name)
+                return self._result(function(session, *args))
+            except XapiError, e:
+                # A new login helps when the session expired
+                if e.details and e.details[0] == 'SESSION_INVALID':
+                    self._dropSession(master)
+                    if cached:
+                        continue
+                if self.DEBUG == 1:
+                    print "Debug: XAPI call " + method + " on " + address + " failed: " + str(e)
+                return None
+            except Exception, e:
+                self._dropSession(master)
+                # The master of a cached session may have rebooted or moved,
+                # log in again once
+                if cached:
+                    continue
+                if self.DEBUG == 1:
+                    print "Debug: XAPI call " + method + " on " + address + " failed: " + str(e)
+                return None
+        return None
+
+    # Get all records of a class (like 'VM' or 'host'), by reference
+    def get_all_records(self, address, xapiClass):
+        return self.call(address, xapiClass + '.get_all_records')
+
+    # Get the reference and record of a host by its name
+    def get_host(self, address, hostname):
+        hosts = self.get_all_records(address, 'host')
+        if hosts is None:
+            return None, None
+        for ref, record in hosts.iteritems():
+            if record['name_label'] == hostname:
+                return ref, record
+        return None, None
+
+    # Get the vms running on a host, leaving out the control domain
+    def get_resident_vms(self, address, hostname):
+        hostRef, host = self.get_host(address, hostname)
+        if hostRef is None:
+            return None
+        vms = self.get_all_records(address, 'VM')
+        if vms is None:
+            return None
+        resident = {}
+        for ref, record in vms.iteritems():
+            if record['resident_on'] != hostRef or record['is_control_domain']:
+                continue
+            resident[ref] = record
+        return resident
+
+    # Follow the vms running on a host using XAPI events. Returns None when
+    # XAPI could not be used.
+    def watch_resident_vms(self, address, hostname):
+        hostRef, host = self.get_host(address, hostname)
+        if hostRef is None:
+            return None
+        watcher = ResidentVmWatcher(self, address, hostRef)
+        if watcher.wait(0) is None:
+            return None
+        return watcher
+
+
+# Keeps track of the vms running on a host, using XAPI event.from. Waiting
+# returns as soon as a vm arrives or leaves, without polling the host.
+class ResidentVmWatcher(object):
+
+    def __init__(self, client, address, hostRef):
+        self.client = client
+        self.address = address
+        self.hostRef = hostRef
+        self.token = ''
+        self.vms = {}
+        self.count = None
+
+    # Wait until the number of vms on the host changes, or timeout seconds
+    # passed. Returns the number of vms, None when XAPI failed.
+    def wait(self, timeout=30):
+        deadline = time.time() + timeout
+        previous = self.count
+        while True:
+            # Stay below the timeout of the HTTP connection
+            remaining = max(0, min(deadline - time.time(), self.client.timeout - 5))
+            # The first call, without token, returns all vms
+            result = self.client.call(
+                self.address, 'event.from', ['vm'], self.token, float(remaining))
+            if result is None:
+                return None
+            self.token = result['token']
+            for event in result['events']:
+                record = event.get('snapshot')
+                if event['operation'] == 'del' or not record or \
+                        record['resident_on'] != self.hostRef or record['is_control_domain']:
+                    self.vms.pop(event['ref'], None)
+                else:
+                    self.vms[event['ref']] = True
+            self.count = len(self.vms)
+            if self.count != previous or time.time() >= deadline:
+                return self.count
@@ -25,11 +25,20 @@ import sys
 import time
 import os
 import requests
+import re
+import json
+import ConfigParser
+import glob
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+from xapiclient import XapiClient
 
 # Fabric
 from fabric.api import *
 from fabric import api as fab
 from fabric import *
+from fabric.state import connections
 
 # Set user/passwd for fabric ssh
 env.user = 'root'
@@ -51,11 +60,71 @@ output['warnings'] = False
 class xenserver():
 
     def __init__(self, ssh_user='root', threads=5, pre_empty_script='xenserver_pre_empty_script.sh',
-                 post_empty_script='xenserver_post_empty_script.sh'):
+                 post_empty_script='xenserver_post_empty_script.sh', fan_out_pool_size=10,
+                 configfile=os.getcwd() + '/config'):
         self.ssh_user = ssh_user
         self.threads = threads
         self.pre_empty_script = pre_empty_script
         self.post_empty_script = post_empty_script
+        self.fan_out_pool_size = fan_out_pool_size
+        self.xapi = self.init_xapi(configfile)
+        # CloudStackOps instance, to check what CloudStack thinks of a host
+        self.cloudstackops = None
+        self.patch_directory = 'xenserver_patches'
+        self.patch_manifest_file = 'manifest.json'
+        self.patch_manifest_lock = threading.Lock()
+        self.download_chunk_size = 1024 * 1024
+        self.remote_patch_cache = '/root/xenserver_patches_cache'
+
+    # Setup the XAPI client with the credentials from the [xenserver] section
+    # of the config file. Without them everything is done over SSH.
+    def init_xapi(self, configfile):
+        config = ConfigParser.RawConfigParser()
+        config.read(configfile)
+        xapi_user = self.ssh_user
+        xapi_password = None
+        xapi_timeout = 30
+        if config.has_option('xenserver', 'xapi_user'):
+            xapi_user = config.get('xenserver', 'xapi_user')
+        if config.has_option('xenserver', 'xapi_password'):
+            xapi_password = config.get('xenserver', 'xapi_password')
+        if config.has_option('xenserver', 'xapi_timeout'):
+            xapi_timeout = config.getint('xenserver', 'xapi_timeout')
+        if not xapi_password:
+            print "Note: No xapi_password in the [xenserver] section of the config file, talking to XenServer over SSH only."
+        return XapiClient(xapi_user, xapi_password, xapi_timeout)
+
+    # Run function(host, *args) on all hosts at the same time, in at most
+    # fan_out_pool_size processes (Fabric parallel mode; its env is global,
+    # so threads cannot be used). Returns a dict with the result per host name.
+    def fan_out(self, hosts, function, *args):
+        hosts_by_string = {}
+        for host in hosts:
+            hosts_by_string[self.ssh_user + "@" + host.ipaddress] = host
+
+        def task():
+            # We are a forked copy, get our own XAPI and API connections
+            self.xapi.forgetSessions()
+            if self.cloudstackops is not None:
+                self.cloudstackops.resetConnection()
+            try:
+                return function(hosts_by_string[env.host_string], *args)
+            finally:
+                # Forked processes exit without running atexit handlers
+                self.xapi.logout()
+
+        results = {}
+        if len(hosts_by_string) == 0:
+            return results
+        try:
+            with settings(parallel=True, pool_size=self.fan_out_pool_size, warn_only=True):
+                for host_string, result in execute(task, hosts=hosts_by_string.keys()).iteritems():
+                    if isinstance(result, Exception):
+                        result = False
+                    results[hosts_by_string[host_string].name] = result
+        except:
+            print "Warning: Running on all hosts at the same time failed"
+        return results
 
     # Wait for hypervisor to become alive again
     def check_connect(self, host):
@@ -78,8 +147,65 @@ class xenserver():
         # Remove progress indication
         sys.stdout.write("\033[F")
         print "Note: Host " + host.name + " is able to do XE stuff again!                                  "
-        print "Note: Waiting 60s to allow the hypervisor to connect.."
-        time.sleep(60)
+        print "Note: Waiting for the hypervisor to be enabled and connected.."
+        if not self.wait_for_host_ready(host, 600):
+            print "Warning: Host " + host.name + " is not ready after 600s, continuing anyway."
+        return True
+
+    # Call check until it returns True, for at most timeout seconds.
+    # Returns whether it did.
+    def wait_until(self, check, timeout, interval=5):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                if check():
+                    return True
+            except:
+                pass
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
+    # Wait until a host is enabled and live in XAPI and Up in CloudStack.
+    # Each check is done when we can: XAPI only when we can log in to it.
+    def wait_for_host_ready(self, host, timeout):
+        deadline = time.time() + timeout
+        if self.xapi.get_host(host.ipaddress, host.name)[0] is not None:
+            if not self.wait_until(lambda: self.host_ready(host), timeout):
+                return False
+        elif self.cloudstackops is None:
+            # Nothing to check with, so wait like we used to
+            print "Note: Cannot ask XAPI nor CloudStack about host " + host.name + ", waiting 60s"
+            time.sleep(60)
+            return True
+        if self.cloudstackops is None:
+            return True
+        return self.wait_until(lambda: self.host_up_in_cloudstack(host), max(0, deadline - time.time()))
+
+    # Is the host enabled and live in XAPI
+    def host_ready(self, host):
+        host_ref, record = self.xapi.get_host(host.ipaddress, host.name)
+        if record is None or not record['enabled']:
+            return False
+        return self.xapi.call(host.ipaddress, 'host_metrics.get_live', record['metrics']) is True
+
+    # Is the host Up in CloudStack. Hosts of an unmanaged cluster only
+    # connect after it is managed again, so there is nothing to wait for.
+    def host_up_in_cloudstack(self, host):
+        clusters = self.cloudstackops.listClusters({'clusterid': host.clusterid})
+        if clusters is None or clusters == 1 or clusters[0].managedstate != "Managed":
+            return True
+        hosts = self.cloudstackops.getHostData({'hostid': host.id})
+        return hosts is not None and hosts != 1 and hosts[0].state == "Up"
+
+    # Does CloudStack know all vms left the host
+    def vms_synced_in_cloudstack(self, host):
+        clusters = self.cloudstackops.listClusters({'clusterid': host.clusterid})
+        if clusters is None or clusters == 1 or clusters[0].managedstate != "Managed":
+            return True
+        for vmdata in self.cloudstackops.getVirtualMachinesRunningOnHost(host.id):
+            if vmdata is not None and vmdata != 1 and len(vmdata) > 0:
+                return False
         return True
 
     # Check if we can use xapi
@@ -95,9 +221,13 @@ class xenserver():
             return False
 
     # Check if we are really offline
-    def check_offline(self, host):
+    def check_offline(self, host, timeout=600):
         print "Note: Waiting for " + host.name + " to go offline"
+        deadline = time.time() + timeout
         while os.system("ping -c 1 " + host.ipaddress + " 2>&1 >/dev/null") == 0:
+            if time.time() > deadline:
+                print "Warning: Host " + host.name + " did not go offline within " + str(timeout) + "s"
+                return False
             # Progress indication
             sys.stdout.write(".")
             sys.stdout.flush()
@@ -105,9 +235,15 @@ class xenserver():
         # Remove progress indication
         sys.stdout.write("\033[F")
         print "Note: Host " + host.name + " is now offline!                           "
+        return True
 
     # Return host of poolmaster
     def get_poolmaster(self, host):
+        pools = self.xapi.get_all_records(host.ipaddress, 'pool')
+        if pools:
+            master = self.xapi.call(host.ipaddress, 'host.get_name_label', pools.values()[0]['master'])
+            if master is not None:
+                return master
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
                 return fab.run("xe host-list uuid=$(xe pool-list params=master | awk {'print $5'}) params=name-label | awk {'print $5'} | tr -d '\n'")
@@ -116,6 +252,13 @@ class xenserver():
 
     # Get current patchlevel
     def get_patch_level(self, host):
+        patches = self.xapi.get_all_records(host.ipaddress, 'pool_patch')
+        if patches is not None:
+            patch_level = ""
+            for patch in sorted(patches.values(), key=lambda p: p['name_label']):
+                if re.match('XS.*E', patch['name_label']):
+                    patch_level += "%s (%d) " % (patch['name_label'], len(patch['host_patches']))
+            return patch_level
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
                 return fab.run("for p in $(xe patch-list | grep XS.*E | awk {'print $4'} | tr -d \" \" |\
@@ -133,6 +276,9 @@ class xenserver():
     # Put a host to service in XenServer
     def host_enable(self, host):
         print "Note: Enabling host " + host.name
+        host_ref, host_record = self.xapi.get_host(host.ipaddress, host.name)
+        if host_ref is not None and self.xapi.call(host.ipaddress, 'host.enable', host_ref) is not None:
+            return True
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
                 return fab.run("xe host-enable host=" + host.name)
@@ -149,58 +295,130 @@ class xenserver():
             print "Warning: host_disable returned false for " + host.name
             return False
 
-    # Live migrate all VMS off of a hypervisor
-    def host_evacuate(self, host):
-        print "Note: Evacuating host " + host.name + " @ " + time.strftime("%Y-%m-%d %H:%M")
-        print "Note: Migration progress will appear here.."
+    # Live migrate all VMS off of these hypervisors at the same time. They
+    # share one migration plan, so no two of them count on the same free
+    # memory of the other hypervisors.
+    def hosts_evacuate(self, hosts):
+        print "Note: Evacuating host " + ", ".join([h.name for h in hosts]) + " @ " + time.strftime("%Y-%m-%d %H:%M")
         try:
-            with settings(host_string=self.ssh_user + "@" + host.ipaddress):
-                fab.run("nohup python /tmp/xenserver_parallel_evacuate.py --exec --threads " + str(self.threads) + " >& /dev/null < /dev/null &", pty=False)
+            evacuate_hosts = ""
+            if len(hosts) > 1:
+                evacuate_hosts = " --hosts " + ",".join([h.name for h in hosts])
+            with settings(host_string=self.ssh_user + "@" + hosts[0].ipaddress):
+                fab.run("nohup python /tmp/xenserver_parallel_evacuate.py --exec --threads " + str(self.threads) +
+                        evacuate_hosts + " >& /dev/null < /dev/null &", pty=False)
+        except:
+            return False
 
+        # The migrations run at the same time, following them one by one
+        # takes as long as the slowest host
+        for host in hosts:
+            if self.follow_evacuation(host) is False:
+                return False
+        return True
+
+    # Wait until the migrations emptied a host, and Cosmic knows about it
+    def follow_evacuation(self, host):
+        print "Note: Migration progress will appear here.."
+        try:
+            # Follow the migrations using XAPI events, or else poll every 5s
+            watcher = self.xapi.watch_resident_vms(host.ipaddress, host.name)
+            if watcher is None:
+                print "Note: No XAPI events for host " + host.name + ", polling its vm count every 5s instead\n"
             while True:
-                numer_of_vms = self.host_get_vms(host)
+                if watcher is not None:
+                    numer_of_vms = str(watcher.count)
+                else:
+                    numer_of_vms = self.host_get_vms(host)
                 # Overwrite previous lin_
                 sys.stdout.write("\033[F")
                 print "Progress: On host " + host.name + " there are " + numer_of_vms + " VMs left to be migrated.."
                 if int(numer_of_vms) == 0:
                     break
-                time.sleep(5)
+                if watcher is not None:
+                    if watcher.wait(60) is None:
+                        print "Warning: Lost XAPI events for host " + host.name + ", polling its vm count every 5s instead\n"
+                        watcher = None
+                else:
+                    time.sleep(5)
             print "Note: Done evacuating host " + host.name + " @ " + time.strftime("%Y-%m-%d %H:%M")
-            print "Note: Sleeping 2 minutes to allow Cosmic to sync the state of VMs.."
-            time.sleep(120)
+            if self.cloudstackops is None:
+                print "Note: Sleeping 2 minutes to allow Cosmic to sync the state of VMs.."
+                time.sleep(120)
+            else:
+                print "Note: Waiting for Cosmic to sync the state of VMs.."
+                if not self.wait_until(lambda: self.vms_synced_in_cloudstack(host), 300):
+                    print "Warning: Cosmic still has VMs on host " + host.name + " after 300s, continuing anyway."
             return True
         except:
             return False
 
-    # Reboot a host when all conditions are met
-    def host_reboot(self, host, halt_hypervisor=False):
-        # Disable host
-        if self.host_disable(host) is False:
-            print "Error: Disabling host " + host.name + " failed."
+    # Check on the poolmaster that every host can be emptied onto the others
+    def check_cluster_capacity(self, host):
+        print "Note: Checking that every host of the pool can be emptied onto the other hosts.."
+        try:
+            with settings(show('output'), warn_only=True, host_string=self.ssh_user + "@" + host.ipaddress):
+                result = fab.run("python /tmp/xenserver_parallel_evacuate.py --check-cluster")
+                if result.return_code == 0:
+                    return True
+                return False
+        except:
             return False
 
-        # Execute pre-empty-script
-        if self.exec_script_on_hypervisor(host, self.pre_empty_script) is False:
-            print "Error: Executing script '" + self.pre_empty_script + "' on host " + host.name + " failed."
+    # Check on the poolmaster that these hosts can be emptied at the same time
+    def check_hosts_capacity(self, poolmaster, hosts):
+        try:
+            with settings(show('output'), warn_only=True, host_string=self.ssh_user + "@" + poolmaster.ipaddress):
+                result = fab.run("python /tmp/xenserver_parallel_evacuate.py --check-hosts " +
+                                 ",".join([h.name for h in hosts]))
+                if result.return_code == 0:
+                    return True
+                return False
+        except:
             return False
 
-        # Then evacuate it
-        if self.host_evacuate(host) is False:
-            print "Error: Evacuating host " + host.name + " failed."
+    # Reboot a host when all conditions are met
+    def host_reboot(self, host, halt_hypervisor=False):
+        if self.hosts_empty([host]) is False:
             return False
-
-        # Count VMs to be sure
-        if self.host_get_vms(host) != "0":
-            print "Error: Host " + host.name + " not empty, cannot reboot!"
+        if self.host_restart(host, halt_hypervisor) is False:
             return False
-        print "Note: Host " + host.name + " has no VMs running, continuing"
+        return self.host_wait_for_return(host)
+
+    # Disable hosts and empty them together, running the scripts around it
+    def hosts_empty(self, hosts):
+        for host in hosts:
+            # Disable host
+            if self.host_disable(host) is False:
+                print "Error: Disabling host " + host.name + " failed."
+                return False
 
-        # Execute post-empty-script
-        if self.exec_script_on_hypervisor(host, self.post_empty_script) is False:
-            print "Error: Executing script '" + self.post_empty_script + "' on host " + host.name + " failed."
+            # Execute pre-empty-script
+            if self.exec_script_on_hypervisor(host, self.pre_empty_script) is False:
+                print "Error: Executing script '" + self.pre_empty_script + "' on host " + host.name + " failed."
+                return False
+
+        # Then evacuate them
+        if self.hosts_evacuate(hosts) is False:
+            print "Error: Evacuating host " + ", ".join([h.name for h in hosts]) + " failed."
             return False
 
-        # Finally reboot it
+        for host in hosts:
+            # Count VMs to be sure
+            if self.host_get_vms(host) != "0":
+                print "Error: Host " + host.name + " not empty, cannot reboot!"
+                return False
+            print "Note: Host " + host.name + " has no VMs running, continuing"
+
+            # Execute post-empty-script
+            if self.exec_script_on_hypervisor(host, self.post_empty_script) is False:
+                print "Error: Executing script '" + self.post_empty_script + "' on host " + host.name + " failed."
+                return False
+        return True
+
+    # Reboot an empty host, and return once it went offline. Use
+    # host_wait_for_return to put it back to service.
+    def host_restart(self, host, halt_hypervisor=False):
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
                 if halt_hypervisor:
@@ -213,9 +431,16 @@ class xenserver():
             print "Error: Rebooting host " + host.name + " failed."
             return False
 
-        # Check the host is really offline
-        self.check_offline(host)
+        # Check the host is really offline, right away, as it may be back
+        # already by the time we wait for it
+        if self.check_offline(host) is False:
+            print "Error: Host " + host.name + " did not go down after the reboot command."
+            return False
+        return True
 
+    # Wait for a rebooted host, that went offline already, to return and
+    # put it back to service
+    def host_wait_for_return(self, host):
         # Wait until the host is back
         self.check_connect(host)
 
@@ -223,6 +448,7 @@ class xenserver():
         if self.host_enable(host) is False:
             print "Error: Enabling host " + host.name + " failed."
             return False
+        return True
 
     # Execute script on hypervisor
     def exec_script_on_hypervisor(self, host, script):
@@ -236,6 +462,9 @@ class xenserver():
 
     # Get VM count of a hypervisor
     def host_get_vms(self, host):
+        vms = self.xapi.get_resident_vms(host.ipaddress, host.name)
+        if vms is not None:
+            return str(len(vms))
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
                 return fab.run("xe vm-list resident-on=$(xe host-list params=uuid \
@@ -272,6 +501,9 @@ class xenserver():
 
     # Check the current state of HA
     def pool_ha_check(self, host):
+        pools = self.xapi.get_all_records(host.ipaddress, 'pool')
+        if pools:
+            return pools.values()[0]['ha_enabled']
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
                 if fab.run("xe pool-list params=ha-enabled | awk {'print $5'} | tr -d '\n'") == "true":
@@ -290,24 +522,30 @@ class xenserver():
             print "Error: Enabling host " + host.name + " failed."
             return False
 
-    # Upload check scripts
+    # The scripts we need on the hypervisors, as (local, remote) paths
+    def script_files(self):
+        scripts = ['xenserver_check_bonds.py', 'xenserver_fake_pvtools.sh', 'xenserver_create_vlans.sh',
+                   'xenserver_parallel_evacuate.py']
+        if len(self.pre_empty_script) > 0:
+            scripts.append(self.pre_empty_script)
+        if len(self.post_empty_script) > 0:
+            scripts.append(self.post_empty_script)
+        return [(script, '/tmp/' + script.split('/')[-1]) for script in scripts]
+
+    # Upload scripts, skipping the ones the host already has. The checksums
+    # are compared on the host, as /tmp is empty again after a reboot.
     def put_scripts(self, host):
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
-                put('xenserver_check_bonds.py',
-                    '/tmp/xenserver_check_bonds.py', mode=0755)
-                put('xenserver_fake_pvtools.sh',
-                    '/tmp/xenserver_fake_pvtools.sh', mode=0755)
-                put('xenserver_create_vlans.sh',
-                    '/tmp/xenserver_create_vlans.sh', mode=0755)
-                put('xenserver_parallel_evacuate.py',
-                    '/tmp/xenserver_parallel_evacuate.py', mode=0755)
-                if len(self.pre_empty_script) > 0:
-                    put(self.pre_empty_script,
-                        '/tmp/' + self.pre_empty_script.split('/')[-1], mode=0755)
-                if len(self.post_empty_script) > 0:
-                    put(self.post_empty_script,
-                        '/tmp/' + self.post_empty_script.split('/')[-1], mode=0755)
+                files = self.script_files()
+                deployed = {}
+                for line in run('sha256sum ' + ' '.join([f[1] for f in files]) + ' 2>/dev/null; true').splitlines():
+                    fields = line.split()
+                    if len(fields) == 2:
+                        deployed[fields[1]] = fields[0]
+                for local, remote in files:
+                    if deployed.get(remote) != self.file_checksum(local):
+                        put(local, remote, mode=0755)
             return True
         except:
             print "Warning: Could not upload check scripts to host " + host.name + ". Continuing anyway."
@@ -351,52 +589,254 @@ class xenserver():
         except:
             return False
 
-    # Download XenServer patch
-    def download_patch(self, url):
+    # Read the manifest of verified patch downloads: filename -> sha256, size, mtime and url
+    def read_patch_manifest(self):
+        try:
+            with open(self.patch_directory + '/' + self.patch_manifest_file) as file_pointer:
+                return json.load(file_pointer)
+        except:
+            return {}
+
+    # Record a verified download in the manifest, or forget it with entry None
+    def update_patch_manifest(self, filename, entry):
+        with self.patch_manifest_lock:
+            manifest = self.read_patch_manifest()
+            if entry is None:
+                manifest.pop(filename, None)
+            else:
+                manifest[filename] = entry
+            manifest_file = self.patch_directory + '/' + self.patch_manifest_file
+            with open(manifest_file + '.tmp', 'w') as file_pointer:
+                json.dump(manifest, file_pointer, indent=2, sort_keys=True)
+            os.rename(manifest_file + '.tmp', manifest_file)
+
+    # Calculate the sha256 of a file
+    def file_checksum(self, filename):
+        checksum = hashlib.sha256()
+        with open(filename, 'rb') as file_pointer:
+            for block in iter(lambda: file_pointer.read(self.download_chunk_size), ''):
+                checksum.update(block)
+        return checksum.hexdigest()
+
+    # Get the sha256 of a downloaded patch, from the manifest when the file did not change
+    def patch_checksum(self, filename):
+        entry = self.read_patch_manifest().get(os.path.basename(filename))
+        if entry is not None and os.path.getsize(filename) == entry['size'] and \
+                int(os.path.getmtime(filename)) == entry['mtime']:
+            return entry['sha256']
+        return self.file_checksum(filename)
+
+    # Download all patches from the patch list, a few at the same time.
+    # Each line has an url, optionally followed by the expected sha256.
+    def download_patches(self, patches, pool_size=4):
+        todo = []
+        for line in patches:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            todo.append((fields[0], fields[1] if len(fields) > 1 else None))
+        if len(todo) == 0:
+            return True
+
+        def download(patch):
+            return self.download_patch(patch[0], patch[1])
+
+        pool = ThreadPool(max(1, min(pool_size, len(todo))))
+        try:
+            results = pool.map(download, todo)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [patch[0] for patch, result in zip(todo, results) if result is not True]
+        for url in failed:
+            print "Error: Downloading patch '%s' failed." % url
+        return len(failed) == 0
+
+    # Download XenServer patch. Partial downloads are resumed, and
+    # downloads that were verified before are not fetched again.
+    def download_patch(self, url, checksum=None):
         filename = url.split("/")[-1]
 
-        directory = "xenserver_patches"
+        directory = self.patch_directory
         if not os.path.exists(directory):
             os.makedirs(directory)
 
         destination_file = os.getcwd() + '/' + directory + '/' + filename
+        partial_file = destination_file + '.part'
+
+        entry = self.read_patch_manifest().get(filename)
+        if entry is not None and os.path.exists(destination_file):
+            if checksum is not None and checksum.lower() != entry['sha256']:
+                print "Warning: Checksum of %s does not match the patch list, downloading again." % filename
+            elif os.path.getsize(destination_file) == entry['size'] and \
+                    int(os.path.getmtime(destination_file)) == entry['mtime']:
+                print "Note: Skipping download of %s because it is already downloaded and verified." % filename
+                return True
+
+        # Files from before the manifest, or that changed since, are
+        # treated as a partial download and completed or verified
+        if os.path.exists(destination_file):
+            os.rename(destination_file, partial_file)
+
         try:
-            local_length = int(os.path.getsize(destination_file))
+            local_length = int(os.path.getsize(partial_file))
         except:
             local_length = 0
 
-        print "Note: Executing request.."
+        print "Note: Executing request for %s.." % filename
+        headers = {}
+        if local_length > 0:
+            headers['Range'] = 'bytes=%d-' % local_length
         try:
-            response = requests.get(url, stream=True)
-            remote_length = int(response.headers.get('Content-Length', 0))
-            if not response.ok:
-                return False
+            response = requests.get(url, stream=True, headers=headers)
         except:
             return False
 
-        # Do we need to download?
-        print "Note: The remote length is %s, local length is %s" % (remote_length, local_length)
+        remote_length = None
+        content_range = response.headers.get('Content-Range', '')
+        if '/' in content_range and content_range.split('/')[-1].strip().isdigit():
+            remote_length = int(content_range.split('/')[-1])
+        if response.status_code == 416:
+            # Nothing left to get when we have all of it (bytes */length),
+            # else our partial file is not a part of it at all
+            response.close()
+            if remote_length is None or local_length != remote_length:
+                print "Warning: Partial download of %s does not match the file on the server, downloading again." % \
+                      filename
+                os.remove(partial_file)
+                return self.download_patch(url, checksum)
+            print "Note: Download of %s is already complete." % filename
+        elif response.status_code == 206:
+            print "Note: Resuming download of %s at %s bytes.." % (filename, local_length)
+        elif response.ok:
+            remote_length = None
+            if 'Content-Length' in response.headers:
+                remote_length = int(response.headers['Content-Length'])
+            local_length = 0
+            print "Note: Downloading %s.." % filename
+        else:
+            return False
 
-        if remote_length == local_length:
-            print "Note: Skipping download because file is already downloaded."
-            return True
+        if response.status_code != 416:
+            try:
+                with open(partial_file, 'ab' if local_length > 0 else 'wb') as handle:
+                    for block in response.iter_content(self.download_chunk_size):
+                        handle.write(block)
+            except:
+                print "Warning: Download of %s was interrupted, it will be resumed next time." % filename
+                return False
+        response.close()
 
-        with open(destination_file, 'wb') as handle:
-            # Download file
-            print "Note: Downloading file.."
+        size = os.path.getsize(partial_file)
+        if remote_length is not None and size != remote_length:
+            print "Warning: Download of %s is incomplete (%s of %s bytes), it will be resumed next time." % \
+                  (filename, size, remote_length)
+            return False
+
+        sha256 = self.file_checksum(partial_file)
+        if checksum is not None and checksum.lower() != sha256:
+            print "Error: Checksum of %s is %s, expected %s. Removing download." % (filename, sha256, checksum)
+            os.remove(partial_file)
+            return False
 
-            for block in response.iter_content(1024):
-                handle.write(block)
+        os.rename(partial_file, destination_file)
+
+        # Only skip it next time when its size or checksum was confirmed
+        if remote_length is None and checksum is None:
+            self.update_patch_manifest(filename, None)
+            print "Warning: Downloaded %s (sha256 %s), but the server did not tell its size to verify it." % \
+                  (filename, sha256)
             return True
+        self.update_patch_manifest(filename, {
+            'sha256': sha256,
+            'size': size,
+            'mtime': int(os.path.getmtime(destination_file)),
+            'url': url
+        })
+        print "Note: Downloaded and verified %s (sha256 %s)" % (filename, sha256)
+        return True
+
+    # Upload files to a host, several at the same time over separate SFTP
+    # channels of its SSH connection. files is a list of (local, remote).
+    def put_files(self, host, files, pool_size=4):
+        if len(files) == 0:
+            return True
+        client = connections[self.ssh_user + "@" + host.ipaddress]
+
+        def upload(f):
+            try:
+                sftp = client.open_sftp()
+                try:
+                    sftp.put(f[0], f[1])
+                finally:
+                    sftp.close()
+                return True
+            except Exception as e:
+                print "Warning: Uploading %s to %s failed: %s" % (f[0], host.name, str(e))
+                return False
 
-    # Upload patches to poolmaster
+        pool = ThreadPool(max(1, min(pool_size, len(files))))
+        try:
+            results = pool.map(upload, files)
+        finally:
+            pool.close()
+            pool.join()
+        return False not in results
+
+    # Upload patches to poolmaster. The poolmaster keeps the patches in a
+    # cache by their sha256, so only the ones it does not have are uploaded.
     def put_patches_to_poolmaster(self, host):
         print "Note: Uploading patches to poolmaster.."
+        cache = self.remote_patch_cache
+        patches = {}
+        for filename in sorted(glob.glob(self.patch_directory + '/*.zip')):
+            patches[os.path.basename(filename)] = self.patch_checksum(filename)
+        wanted = set(patches.values())
+
         try:
             with settings(host_string=self.ssh_user + "@" + host.ipaddress):
+                run('mkdir -p ' + cache)
+                cached = set()
+                stale = []
+                for name in run('ls -1 ' + cache).split():
+                    if re.match('^[0-9a-f]{64}\.zip$', name) and name[:64] in wanted:
+                        cached.add(name[:64])
+                    else:
+                        stale.append(name)
+
+                # Make room first, the control domain has little disk space
+                if len(stale) > 0:
+                    run('cd ' + cache + ' && rm -f ' + ' '.join(["'" + name + "'" for name in stale]))
+
+                missing = {}
+                for filename, checksum in patches.iteritems():
+                    if checksum not in cached and checksum not in missing:
+                        missing[checksum] = filename
+                print "Note: Poolmaster has %s of %s patches already, uploading %s" % \
+                      (len(wanted) - len(missing), len(wanted), len(missing))
+
+                uploads = [(self.patch_directory + '/' + filename, cache + '/' + checksum + '.zip.part')
+                           for checksum, filename in missing.iteritems()]
+                if not self.put_files(host, uploads):
+                    raise Exception("upload failed")
+
+                # Verify what arrived before adding it to the cache
+                if len(missing) > 0:
+                    run('cd ' + cache + ' && for f in *.zip.part; do '
+                        '[ "$(sha256sum $f | cut -d " " -f 1)" == "${f%.zip.part}" ] && mv $f ${f%.part}; '
+                        'rm -f $f; done')
+                    present = run('ls -1 ' + cache).split()
+                    failed = [filename for checksum, filename in missing.iteritems()
+                              if checksum + '.zip' not in present]
+                    if len(failed) > 0:
+                        print "Error: Checksum of %s did not match after uploading." % ", ".join(failed)
+                        raise Exception("checksum mismatch")
+
                 run('rm -rf /root/xenserver_patches/')
                 run('mkdir -p /root/xenserver_patches')
-                put('xenserver_patches/*', '/root/xenserver_patches')
+                for filename, checksum in patches.iteritems():
+                    run("ln -f %s/%s.zip '/root/xenserver_patches/%s'" % (cache, checksum, filename))
                 put('xenserver_upload_patches_to_poolmaster.sh',
                     '/root/xenserver_patches/xenserver_upload_patches_to_poolmaster.sh', mode=0755)
             return True
@@ -54,6 +54,10 @@ def handleArguments(argv):
     force = 0
     global checkBonds
     checkBonds = True
+    global maxMigrations
+    maxMigrations = 1
+    global maxMigrationsPerHost
+    maxMigrationsPerHost = 2
 
     # Usage message
     help = "Usage: ./" + os.path.basename(__file__) + ' [options] ' + \
@@ -61,6 +65,8 @@ def handleArguments(argv):
         '\n  --hostname|-n <hostname>\t\tWork with this hypervisor' + \
         '\n  --cancel-maintenance\t\t\tCancel maintenance for this hypervisor' + \
         '\n  --no-bond-check\t\t\tSkip the bond check' + \
+        '\n  --max-migrations <number>\t\tLive migrate this many vm\'s at the same time (default 1)' + \
+        '\n  --max-migrations-per-host <number>\tMigrate at most this many vm\'s at the same time to one host (default 2)' + \
         '\n  --force\t\t\t\tForce put in maintenance, even when there is already a hypervisor in maintenance' + \
         '\n  --debug\t\t\t\tEnable debug mode' + \
         '\n  --exec\t\t\t\tExecute for real'
@@ -68,7 +74,7 @@ def handleArguments(argv):
     try:
         opts, args = getopt.getopt(
             argv, "hc:n:", [
-                "credentials-file=", "hostname=", "debug", "exec", "cancel-maintenance", "force", "no-bond-check"])
+                "credentials-file=", "hostname=", "debug", "exec", "cancel-maintenance", "force", "no-bond-check", "max-migrations=", "max-migrations-per-host="])
     except getopt.GetoptError as e:
         print "Error: " + str(e)
         print help
@@ -91,6 +97,10 @@ def handleArguments(argv):
             force = 1
         elif opt in ("--no-bond-check"):
             checkBonds = False
+        elif opt in ("--max-migrations"):
+            maxMigrations = int(arg)
+        elif opt in ("--max-migrations-per-host"):
+            maxMigrationsPerHost = int(arg)
 
     # Default to cloudmonkey default config file
     if len(configProfileName) == 0:
@@ -221,7 +231,7 @@ if DEBUG == 1:
     print "Debug: Host to put in maintenance: " + hostID
 
 # Migrate all vm's and empty hypervisor
-c.emptyHypervisor(hostID)
+c.emptyHypervisor(hostID, maxMigrations, maxMigrationsPerHost)
 
 # Put host in CloudStack Maintenance
 maintenanceresult = c.startMaintenance(hostID, hostname)
@@ -26,23 +26,104 @@ import sys
 import getopt
 import math
 import os.path
+import threading
+from multiprocessing.pool import ThreadPool
 
 from cloudstackops import cloudstackops
 from cloudstackops import cloudstackopsssh
+from cloudstackops import cloudstacksnapshot
 from cloudstackops.cloudstackstorage import StorageHelper
 
 from prettytable import PrettyTable
 
 
-def get_volume_filesize(file_uuid_in_cloudstack, *filelist):
-    filelist, = filelist
-    size = None
-    for filepath in filelist.keys():
-        file_uuid_on_storagepool = filepath.split('/')[-1].split('.')[:1][0]
+# Index a file listing of a storage pool by the uuid in the file name,
+# the sizes of files with the same uuid are added up
+def index_volume_files(filelist):
+    index = {}
+    for filepath, filesize in filelist:
+        file_uuid_on_storagepool = filepath.split('/')[-1].split('.')[0]
+        index[file_uuid_on_storagepool] = index.get(file_uuid_on_storagepool, 0) + filesize
+    return index
+
+# Scan one storage pool for orphaned disks, returns the report to print
+# and the row for the totals table
+def scan_storagepool(scan):
+    cluster, storagepool, hypervisor, primary_mountpoint = scan
+    report = []
+    used_space = 0
+
+    # Get list of orphaned cloudstack disks for storagepool
+    sys.stdout.write("[INFO]: Retrieving list of orphans for storage pool " + storagepool.name + "\n")
+    volumes = c.listVolumes(storagepool.id, False)
+    orphans = c.getDetachedVolumes(storagepool.id, volumes)
+    volume_paths = set([volume.path for volume in volumes + c.listVolumes(storagepool.id, 'true')])
+
+    if primary_mountpoint is None:
+        report.append("[DEBUG]: no physical volume list retrieved for " + storagepool.name + " skipping")
+        storagepool_filelist = None
+
+    else:
+        # limit the number of scans running on the same hypervisor
+        with host_slots[hypervisor.ipaddress]:
+            try:
+                storagepool_filelist = index_volume_files(storagehelper.list_files(
+                    hypervisor.ipaddress, primary_mountpoint))
+            except IOError as error:
+                # a partial list would mark disks as not orphaned
+                report.append("[ERROR]: " + str(error) + ", skipping " + storagepool.name)
+                storagepool_filelist = None
+
+    t = PrettyTable(["Domain", "Account", "Name", "Cluster", "Storagepool", "Path",
+                     "Allocated Size (GB)", "Real Size (GB)", "Orphaned"])
+
+    for orphan in orphans:
+        isorphaned = ''
+
+        orphan_allocated_sizeGB = (orphan.size / math.pow(1024, 3))
+
+        if storagepool_filelist is None:
+            orphan_real_sizeGB = 'n/a'
+            isorphaned = '?'
+
+        else:
+            orphan_real_sizeGB = storagepool_filelist.get(orphan.path)
+
+            if orphan_real_sizeGB is not None:
+                orphan_real_sizeGB = orphan_real_sizeGB / math.pow(1024, 3)
+                used_space += orphan_real_sizeGB
+                orphan_real_sizeGB = format(
+                    orphan_real_sizeGB, '.2f')
+                isorphaned = 'Y'
+
+            else:
+                orphan_real_sizeGB = 0
+                isorphaned = 'N'
+
+        # add a row with orphan details
+        t.add_row([orphan.domain, orphan.account, orphan.name, cluster.name, storagepool.name, orphan.path,
+                   orphan_allocated_sizeGB, orphan_real_sizeGB, isorphaned])
+
+    # Orphan table
+    report.append(t.get_string())
+
+    # Files on the storage pool that no CloudStack volume refers to,
+    # like base copies of VHD chains, templates or real leftovers
+    unmatched = []
+    if storagepool_filelist is not None:
+        unmatched = sorted(set(storagepool_filelist.keys()) - volume_paths)
+
+    if len(unmatched) > 0:
+        t_unmatched = PrettyTable(["Cluster", "Storagepool", "File uuid", "Real Size (GB)"])
+
+        for file_uuid in unmatched:
+            t_unmatched.add_row([cluster.name, storagepool.name, file_uuid,
+                                 format(storagepool_filelist[file_uuid] / math.pow(1024, 3), '.2f')])
+
+        report.append("[INFO]: Files on storage pool " + storagepool.name + " that match no CloudStack volume")
+        report.append(t_unmatched.get_string())
 
-        if file_uuid_in_cloudstack == file_uuid_on_storagepool:
-            size = int(filelist[filepath])
-    return size
+    return "\n".join(report), [cluster.name, storagepool.name, len(orphans), format(used_space, '.2f'), len(unmatched)]
 
 # Function to handle our arguments
 
@@ -60,16 +141,26 @@ def handle_arguments(argv):
     clusterarg = ''
     global configProfileName
     configProfileName = ''
+    global snapshotFile
+    snapshotFile = ''
+    global workers
+    workers = 1
+    global max_scans_per_host
+    max_scans_per_host = 1
 
     # Usage message
     help = "Usage: " + os.path.basename(__file__) + ' [options] ' + \
         '\n  --config-profile -c <profilename>\t\tSpecify the CloudMonkey profile name to get the credentials from (or specify in ./config file) [required]' + \
         '\n  --zone -z <zonename>\t\t\t\tZone Name [required]\t' + \
         '\n  --cluster -t <clustername>\t\t\tCluster Name [optional]\t' + \
+        '\n  --from-snapshot <filename>\t\t\tUse this snapshot file instead of the API [optional]' + \
+        '\n  --workers <nr>\t\t\t\tScan this number of storage pools at the same time (default 1) [optional]' + \
+        '\n  --max-scans-per-host <nr>\t\t\tScan at most this number of storage pools via the same hypervisor at the same time (default 1) [optional]' + \
         '\n  --debug\t\t\t\t\tEnable debug mode [optional]'
     try:
         opts, args = getopt.getopt(
-            argv, "hc:z:t:", ["config-profile=", "zone=", "clusterarg=", "debug"])
+            argv, "hc:z:t:", ["config-profile=", "zone=", "clusterarg=", "debug", "from-snapshot=", "workers=",
+                             "max-scans-per-host="])
 
     except getopt.GetoptError as e:
         print "Error: " + str(e)
@@ -87,6 +178,12 @@ def handle_arguments(argv):
             zone = arg
         elif opt in ("-t", "--cluster"):
             clusterarg = arg
+        elif opt in ("--from-snapshot"):
+            snapshotFile = arg
+        elif opt in ("--workers"):
+            workers = int(arg)
+        elif opt in ("--max-scans-per-host"):
+            max_scans_per_host = int(arg)
 
     # Print help if required options not provided
     if len(configProfileName) == 0 or len(zone) == 0:
@@ -109,6 +206,14 @@ c.configProfileName = configProfileName
 # Init the CloudStack API
 c.initCloudStackAPI()
 
+# Answer list calls from a local snapshot instead of the API
+if len(snapshotFile) > 0:
+    snapshot = cloudstacksnapshot.CloudStackSnapshot(DEBUG, DRYRUN)
+    if snapshot.openSnapshot(snapshotFile) != 0:
+        sys.exit(1)
+    c.snapshot = snapshot
+    print "Note: Using snapshot '" + snapshotFile + "' last synced " + snapshot.getInfo('synced')
+
 if DEBUG == 1:
     print "DEBUG: API address: " + c.apiurl
     print "DEBUG: ApiKey: " + c.apikey
@@ -141,9 +246,11 @@ if clusters is None:
     exit(1)
 
 
-# get a list of storage pools for each cluster
-t_storagepool = PrettyTable(
-    ["Cluster", "Storage Pool", "Number of Orphaned disks", "Real Space used (GB)"])
+# get a list of storage pools for each cluster, the mountpoints are looked up
+# here as fabric commands cannot run in the scan threads
+storagehelper = StorageHelper(debug=DEBUG)
+scans = []
+host_slots = {}
 
 for cluster in clusters:
     storagepools = []
@@ -155,14 +262,10 @@ for cluster in clusters:
     # # if there are storage pools (should be)
     if len(storagepools) > 0:
 
-        storagehelper = StorageHelper(debug=DEBUG)
+        if random_hypervisor.ipaddress not in host_slots:
+            host_slots[random_hypervisor.ipaddress] = threading.Semaphore(max_scans_per_host)
 
         for storagepool in storagepools:
-            used_space = 0
-
-            # Get list of orphaned cloudstack disks for storagepool
-            print "[INFO]: Retrieving list of orphans for storage pool", storagepool.name
-            orphans = c.getDetachedVolumes(storagepool.id)
 
             storagepool_devicepath = storagepool.ipaddress + \
                 ":" + str(storagepool.path)
@@ -172,48 +275,22 @@ for cluster in clusters:
             primary_mountpoint = storagehelper.get_mountpoint(
                 random_hypervisor.ipaddress, storagepool_devicepath)
 
-            if primary_mountpoint is None:
-                print "[DEBUG]: no physical volume list retrieved for " + storagepool.name + " skipping"
-                storagepool_filelist = None
-
-            else:
-                storagepool_filelist = storagehelper.list_files(
-                    random_hypervisor.ipaddress, primary_mountpoint)
-
-            t = PrettyTable(["Domain", "Account", "Name", "Cluster", "Storagepool", "Path",
-                             "Allocated Size (GB)", "Real Size (GB)", "Orphaned"])
-
-            for orphan in orphans:
-                isorphaned = ''
+            scans.append((cluster, storagepool, random_hypervisor, primary_mountpoint))
 
-                orphan_allocated_sizeGB = (orphan.size / math.pow(1024, 3))
-
-                if storagepool_filelist is None:
-                    orphan_real_sizeGB = 'n/a'
-                    isorphaned = '?'
-
-                else:
-                    orphan_real_sizeGB = get_volume_filesize(
-                        orphan.path, storagepool_filelist)
-
-                    if orphan_real_sizeGB is not None:
-                        used_space += (orphan_real_sizeGB / 1024)
-                        orphan_real_sizeGB = format(
-                            (orphan_real_sizeGB / 1024), '.2f')
-                        isorphaned = 'Y'
-
-                    else:
-                        orphan_real_sizeGB = 0
-                        isorphaned = 'N'
-
-                # add a row with orphan details
-                t.add_row([orphan.domain, orphan.account, orphan.name, cluster.name, storagepool.name, orphan.path,
-                           orphan_allocated_sizeGB, orphan_real_sizeGB, isorphaned])
-
-            # Print orphan table
-            print t.get_string()
-            t_storagepool.add_row(
-                [cluster.name, storagepool.name, len(orphans), format(used_space, '.2f')])
+# scan the storage pools, printing each one as soon as it is done
+t_storagepool = PrettyTable(
+    ["Cluster", "Storage Pool", "Number of Orphaned disks", "Real Space used (GB)", "Unmatched files"])
+totals = []
+
+pool = ThreadPool(max(1, min(workers, len(scans))))
+for report, total in pool.imap_unordered(scan_storagepool, scans):
+    print report
+    totals.append(total)
+pool.close()
+pool.join()
+
+for total in sorted(totals):
+    t_storagepool.add_row(total)
 
 print "Storagepool Totals"
 print t_storagepool.get_string()
@@ -25,6 +25,7 @@
 import sys
 import getopt
 from cloudstackops import cloudstackops
+from cloudstackops import cloudstacksnapshot
 import os.path
 from prettytable import PrettyTable
 
@@ -73,6 +74,8 @@ def handleArguments(argv):
     ignoreDomainList = ''
     global ignoreDomains
     ignoreDomains = ''
+    global snapshotFile
+    snapshotFile = ''
 
     # Usage message
     help = "Usage: ./" + os.path.basename(__file__) + ' [options]' + \
@@ -105,6 +108,8 @@ def handleArguments(argv):
         'credentials' + \
         '\n  --summary\t\t\t\tDisplay only a summary, no details' + \
         '\n  --no-summary\t\t\t\tDo not display summary' + \
+        '\n  --from-snapshot <filename>\t\tUse this snapshot file ' + \
+        'instead of the API (see snapshotInventory.py)' + \
         '\n  --debug\t\t\t\tEnable debug mode' + \
         '\n  --exec\t\t\t\tExecute for real (not needed for list* scripts)'
 
@@ -120,7 +125,8 @@ def handleArguments(argv):
                 "no-routers", "only-routers",
                 "only-routers-to-be-upgraded",
                 "nic-count-is-minimum",
-                "nic-count-is-maximum", "ignore-domains="
+                "nic-count-is-maximum", "ignore-domains=",
+                "from-snapshot="
             ]
         )
     except getopt.GetoptError as e:
@@ -177,6 +183,8 @@ def handleArguments(argv):
             routerNicCountIsMinimum = 1
         elif opt in ("--nic-count-is-maximum"):
             routerNicCountIsMaximum = 1
+        elif opt in ("--from-snapshot"):
+            snapshotFile = arg
 
     # Default to cloudmonkey default config file
     if len(configProfileName) == 0:
@@ -211,16 +219,20 @@ def printVirtualmachine(args):
         if 'hostMemoryTotal' in args else 0
     ignoreDomains = (args['ignoreDomains']) if 'ignoreDomains' in args else []
     clustername = (args['clustername']) if 'clustername' in args else None
+    storageUsage = (args['storageUsage']) if 'storageUsage' in args else None
 
     if vmdata is not None:
         for vm in vmdata:
             if vm.domain in ignoreDomains:
                 continue
             # Calculate storage usage
-            storageSize = c.calculateVirtualMachineStorageUsage(
-                vm.id,
-                projectParam
-            )
+            if storageUsage is not None:
+                storageSize = storageUsage.get(vm.id, 0)
+            else:
+                storageSize = c.calculateVirtualMachineStorageUsage(
+                    vm.id,
+                    projectParam
+                )
             storageSizeTotal = storageSizeTotal + storageSize
 
             # Memory
@@ -292,6 +304,14 @@ c.configProfileName = configProfileName
 # Init the CloudStack API
 c.initCloudStackAPI()
 
+# Answer list calls from a local snapshot instead of the API
+if len(snapshotFile) > 0:
+    snapshot = cloudstacksnapshot.CloudStackSnapshot(DEBUG, DRYRUN)
+    if snapshot.openSnapshot(snapshotFile) != 0:
+        sys.exit(1)
+    c.snapshot = snapshot
+    print "Note: Using snapshot '" + snapshotFile + "' last synced " + snapshot.getInfo('synced')
+
 if DEBUG == 1:
     print "API address: " + c.apiurl
     print "ApiKey: " + c.apikey
@@ -375,18 +395,27 @@ if nonAdminCredentials == 1:
     sys.exit()
 
 clusters = {}
+clusterZones = {}
+clusterPods = {}
 # ClusterID available
 if 'fromClusterID' in locals():
-    clusters[fromClusterID] = fromCluster
+    result = c.listClusters({'clusterid': fromClusterID})
 else:
     if len(podname) > 0:
         result = c.listClusters({'podid': podID})
-        for cluster in result:
-            clusters[cluster.id] = cluster.name
     else:
         result = c.listClusters({'zoneid': zoneID})
-        for cluster in result:
-            clusters[cluster.id] = cluster.name
+for cluster in result:
+    clusters[cluster.id] = cluster.name
+    clusterZones[cluster.id] = cluster.zoneid
+    clusterPods[cluster.id] = cluster.podid
+
+# Storage usage of all vms, fetched once per zone instead of once per vm
+storageUsageByZone = {}
+
+# Vms and routers, fetched once per pod and grouped by host
+vmsByPod = {}
+routersByPod = {}
 
 if DEBUG == 1:
     print clusters
@@ -414,6 +443,31 @@ for clusterid, clustername in clusters.items():
         print "No (enabled) hosts found on cluster " + clustername
         continue
 
+    clusterZoneID = clusterZones[clusterid]
+    if onlyDisplayRouters < 1 and clusterZoneID not in storageUsageByZone:
+        storageUsageByZone[clusterZoneID] = \
+            c.getVirtualMachinesStorageUsage({
+                'zoneid': clusterZoneID,
+                'domainid': domainnameID,
+                'isProjectVm': projectParam
+            })
+
+    clusterPodID = clusterPods[clusterid]
+    if onlyDisplayRouters < 1 and clusterPodID not in vmsByPod:
+        vmsByPod[clusterPodID] = c.groupByHost(c.listVirtualmachines({
+            'podid': clusterPodID,
+            'domainid': domainnameID,
+            'isProjectVm': projectParam,
+            'projectid': projectnameID,
+            'filterKeyword': filterKeyword
+        }))
+    if displayRouters > 0 and clusterPodID not in routersByPod:
+        routersByPod[clusterPodID] = c.groupByHost(c.getRouterData({
+            'podid': clusterPodID,
+            'domainid': domainnameID,
+            'isProjectVm': projectParam
+        }))
+
     # Look for VMs on each of the cluster hosts
     counter = 0
     hostCounter = 0
@@ -464,13 +518,7 @@ for clusterid, clustername in clusters.items():
         # Get all vms of the domainid running on this host
         if onlyDisplayRouters < 1:
 
-            vmdata = c.listVirtualmachines({
-                'hostid': fromHostData.id,
-                'domainid': domainnameID,
-                'isProjectVm': projectParam,
-                'projectid': projectnameID,
-                'filterKeyword': filterKeyword
-            })
+            vmdata = vmsByPod[clusterPodID].get(fromHostData.id)
 
             storageSizeTotal, memoryTotal, coresTotal, \
                 counter = printVirtualmachine({
@@ -482,7 +530,8 @@ for clusterid, clustername in clusters.items():
                     'storageSizeTotal': storageSizeTotal,
                     'hostMemoryTotal': hostMemoryTotal,
                     'ignoreDomains': ignoreDomains,
-                    'clustername': clustername
+                    'clustername': clustername,
+                    'storageUsage': storageUsageByZone[clusterZoneID]
                 })
 
         # Cores
@@ -492,11 +541,7 @@ for clusterid, clustername in clusters.items():
         if displayRouters < 1:
             continue
 
-        vmdata = c.getRouterData({
-            'hostid': fromHostData.id,
-            'domainid': domainnameID,
-            'isProjectVm': projectParam
-        })
+        vmdata = routersByPod[clusterPodID].get(fromHostData.id)
 
         if vmdata is None:
             continue
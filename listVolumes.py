@@ -26,6 +26,7 @@ import time
 import sys
 import getopt
 from cloudstackops import cloudstackops
+from cloudstackops import cloudstacksnapshot
 import os.path
 from random import choice
 from prettytable import PrettyTable
@@ -46,19 +47,22 @@ def handleArguments(argv):
     storagepoolname = ''
     global isProjectVm
     isProjectVm = 0
+    global snapshotFile
+    snapshotFile = ''
 
     # Usage message
     help = "Usage: ./" + os.path.basename(__file__) + ' [options] ' + \
         '\n  --config-profile -c <profilename>\t\tSpecify the CloudMonkey profile name to get the credentials from (or specify in ./config file)' + \
         '\n  --storagepoolname -p <storage pool name>\tList volumes from this storage pool' + \
         '\n  --is-projectvm\t\t\t\tLimit search to volumes that belong to a project' + \
+        '\n  --from-snapshot <filename>\t\t\tUse this snapshot file instead of the API (see snapshotInventory.py)' + \
         '\n  --debug\t\t\t\t\tEnable debug mode' + \
         '\n  --exec\t\t\t\t\tExecute for real (not needed for list* scripts)'
 
     try:
         opts, args = getopt.getopt(
             argv, "hc:p:", [
-                "config-profile=", "storagepoolname=", "debug", "exec", "is-projectvm"])
+                "config-profile=", "storagepoolname=", "debug", "exec", "is-projectvm", "from-snapshot="])
     except getopt.GetoptError as e:
         print "Error: " + str(e)
         print help
@@ -82,6 +86,8 @@ def handleArguments(argv):
             DRYRUN = 0
         elif opt in ("--is-projectvm"):
             isProjectVm = 1
+        elif opt in ("--from-snapshot"):
+            snapshotFile = arg
 
     # Default to cloudmonkey default config file
     if len(configProfileName) == 0:
@@ -117,6 +123,14 @@ c.configProfileName = configProfileName
 # Init the CloudStack API
 c.initCloudStackAPI()
 
+# Answer list calls from a local snapshot instead of the API
+if len(snapshotFile) > 0:
+    snapshot = cloudstacksnapshot.CloudStackSnapshot(DEBUG, DRYRUN)
+    if snapshot.openSnapshot(snapshotFile) != 0:
+        sys.exit(1)
+    c.snapshot = snapshot
+    print "Note: Using snapshot '" + snapshotFile + "' last synced " + snapshot.getInfo('synced')
+
 if DEBUG == 1:
     print "API address: " + c.apiurl
     print "ApiKey: " + c.apikey
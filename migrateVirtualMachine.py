@@ -190,13 +190,19 @@ if sodata is not None:
 # Volumes
 voldata = c.getVirtualmachineVolumes(vm.id, projectParam)
 
+# Lookup the storage pools of all volumes at once
+storageIDs = c.checkCloudStackNames({'csnames': [vol.storage for vol in voldata],
+                                     'csApiCall': 'listStoragePools'})
+if storageIDs == 1:
+    print "Error: Could not lookup the storage pools of the volumes! Halting!"
+    sys.exit(1)
+
 # Migrate its volumes
 volcount = 0
 volIDs = []
 for vol in voldata:
     # Check if volume is already on correct storage
-    currentStorageID = c.checkCloudStackName(
-        {'csname': vol.storage, 'csApiCall': 'listStoragePools'})
+    currentStorageID = storageIDs.get(vol.storage)
 
     if currentStorageID == targetStorageID:
         print "Warning: No need to migrate volume " + vol.name + " -- already on the desired storage pool. Skipping."
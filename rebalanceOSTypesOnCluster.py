@@ -146,6 +146,11 @@ if fromClusterHostsData == [] or fromClusterHostsData == None:
   print "Nothing to work on, exiting."
   exit (1)
 
+# Get all vm's of the cluster at once: project and non project, grouped by host
+clusterPodID = fromClusterHostsData[0].podid
+vmsByHost_non_project = c.groupByHost(c.listVirtualmachines({'podid': clusterPodID, 'isProjectVm': 'false' }))
+vmsByHost_project = c.groupByHost(c.listVirtualmachines({'podid': clusterPodID, 'isProjectVm': 'true' }))
+
 # Settings
 minInstances = 7
 maxInstances = 25
@@ -186,8 +191,8 @@ for family in osFamilies:
       print "# Memory of this host: " + str(fromHostData.memorytotal)
 
     # Get all vm's: project and non project
-    vmdata_non_project = c.listVirtualmachines({'hostid': fromHostData.id, 'isProjectVm': 'false' })
-    vmdata_project = c.listVirtualmachines({'hostid': fromHostData.id, 'isProjectVm': 'true' })
+    vmdata_non_project = vmsByHost_non_project.get(fromHostData.id)
+    vmdata_project = vmsByHost_project.get(fromHostData.id)
 
     if vmdata_project is None and vmdata_non_project is None:
       print "Note: No vm's of type " + family  + " found on " + fromHostData.name
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Script to save an inventory snapshot of CloudStack to a local SQLite file
+# Remi Bergsma - rbergsma@schubergphilis.com
+
+import sys
+import getopt
+from cloudstackops import cloudstackops
+from cloudstackops import cloudstacksnapshot
+import os.path
+from prettytable import PrettyTable
+
+# Function to handle our arguments
+
+
+def handleArguments(argv):
+    global DEBUG
+    DEBUG = 0
+    global DRYRUN
+    DRYRUN = 0
+    global configProfileName
+    configProfileName = ''
+    global snapshotFile
+    snapshotFile = 'cloudstack_snapshot.db'
+    global refresh
+    refresh = 0
+
+    # Usage message
+    help = "Usage: ./" + os.path.basename(__file__) + ' [options] ' + \
+        '\n  --config-profile -c <profilename>\t\tSpecify the CloudMonkey profile name to get the credentials from (or specify in ./config file)' + \
+        '\n  --snapshot-file -f <filename>\t\t\tWrite the snapshot to this file (default: cloudstack_snapshot.db)' + \
+        '\n  --refresh\t\t\t\t\tOnly update what async jobs changed since the last sync (falls back to a full snapshot).' + \
+        '\n\t\t\t\t\t\tChanges made without a job, like HA restarts, are not seen' + \
+        '\n  --debug\t\t\t\t\tEnable debug mode' + \
+        '\n  --exec\t\t\t\t\tExecute for real (not needed for list* scripts)'
+
+    try:
+        opts, args = getopt.getopt(
+            argv, "hc:f:", [
+                "config-profile=", "snapshot-file=", "refresh", "debug", "exec"])
+    except getopt.GetoptError as e:
+        print "Error: " + str(e)
+        print help
+        sys.exit(2)
+
+    if len(opts) == 0:
+        print help
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print help
+            sys.exit()
+        elif opt in ("-c", "--config-profile"):
+            configProfileName = arg
+        elif opt in ("-f", "--snapshot-file"):
+            snapshotFile = arg
+        elif opt in ("--refresh"):
+            refresh = 1
+        elif opt in ("--debug"):
+            DEBUG = 1
+        elif opt in ("--exec"):
+            DRYRUN = 0
+
+    # Default to cloudmonkey default config file
+    if len(configProfileName) == 0:
+        configProfileName = "config"
+
+# Parse arguments
+if __name__ == "__main__":
+    handleArguments(sys.argv[1:])
+
+# Init our classes
+c = cloudstackops.CloudStackOps(DEBUG, DRYRUN)
+s = cloudstacksnapshot.CloudStackSnapshot(DEBUG, DRYRUN)
+
+if DEBUG == 1:
+    print "# Warning: Debug mode is enabled!"
+
+# make credentials file known to our class
+c.configProfileName = configProfileName
+
+# Init the CloudStack API
+c.initCloudStackAPI()
+
+if DEBUG == 1:
+    print "API address: " + c.apiurl
+    print "ApiKey: " + c.apikey
+    print "SecretKey: " + c.secretkey
+
+# Update the existing snapshot when asked to
+counts = 1
+if refresh == 1 and os.path.isfile(snapshotFile):
+    print "Note: Refreshing snapshot '" + snapshotFile + "'.."
+    if s.openSnapshot(snapshotFile) == 0:
+        counts = s.refreshSnapshot(c)
+        s.closeSnapshot()
+    if counts == 1:
+        print "Note: Refresh not possible, creating a full snapshot instead."
+
+# Fetch everything and write the snapshot
+if counts == 1:
+    print "Note: Creating snapshot '" + snapshotFile + "'.."
+    counts = s.createSnapshot(snapshotFile, c)
+    if counts == 1:
+        sys.exit(1)
+else:
+    s.openSnapshot(snapshotFile)
+
+# Display what we saved
+if refresh == 1:
+    t = PrettyTable(["Type", "Number of objects updated"])
+else:
+    t = PrettyTable(["Type", "Number of objects"])
+t.align["Type"] = "l"
+for table, listCall, columns in s.snapshotTypes:
+    t.add_row([table, counts[table]])
+print t
+print "Note: Snapshot created @ " + s.getInfo('created') + ", last synced @ " + s.getInfo('synced')
+
+s.closeSnapshot()
+
+if DEBUG == 1:
+    print "Note: We're done!"
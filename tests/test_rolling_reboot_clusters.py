@@ -0,0 +1,90 @@
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Check that xenserver_rolling_reboot_clusters.py calls
+# xenserver_rolling_reboot.py with arguments it understands. Both scripts
+# run when imported, so the parts we need are taken from their source.
+
+import ast
+import getopt
+import os
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parseScript(filename):
+    with open(os.path.join(root, filename)) as f:
+        return ast.parse(f.read(), filename)
+
+
+# The short and long options of the getopt call in handleArguments
+def getoptOptions(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                node.func.attr == 'getopt' and len(node.args) == 3:
+            return ast.literal_eval(node.args[1]), ast.literal_eval(node.args[2])
+    raise AssertionError("No getopt call found")
+
+
+# Load one function of a script, with the given globals
+def loadFunction(tree, name, namespace):
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            exec compile(ast.Module(body=[node]), name, 'exec') in namespace
+            return namespace[name]
+    raise AssertionError("No function " + name + " found")
+
+
+class TestRebootClusterArguments(unittest.TestCase):
+
+    def setUp(self):
+        self.shortOptions, self.longOptions = getoptOptions(
+            parseScript('xenserver_rolling_reboot.py'))
+        self.orchestrator = parseScript('xenserver_rolling_reboot_clusters.py')
+
+    def arguments(self, passThrough):
+        namespace = {'configProfileName': 'config',
+                     'patch_list_file': 'xenserver_patches_to_install.txt',
+                     'passThrough': passThrough}
+        return loadFunction(self.orchestrator, 'rebootClusterArguments', namespace)('CLUSTER-1')
+
+    def test_child_accepts_arguments(self):
+        passThrough = ['--threads', '6', '--ignore-hosts', 'host1', '--max-concurrent-hosts', '2',
+                       '--pre-empty-script', 'pre.sh', '--post-empty-script', 'post.sh', '--halt', '--debug',
+                       '--exec']
+        opts, args = getopt.getopt(self.arguments(passThrough), self.shortOptions, self.longOptions)
+        opts = dict(opts)
+        self.assertEqual(args, [])
+        self.assertEqual(opts['--config-profile'], 'config')
+        self.assertEqual(opts['--clustername'], 'CLUSTER-1')
+        self.assertTrue('--preserve-downloads' in opts)
+        self.assertTrue('--exec' in opts)
+
+    def test_child_accepts_pass_through_options(self):
+        # Every option the orchestrator passes on must be known to the child
+        passed = ['--threads', '--ignore-hosts', '--max-concurrent-hosts', '--pre-empty-script',
+                  '--post-empty-script', '--halt', '--debug', '--exec']
+        for option in passed:
+            name = option.lstrip('-')
+            self.assertTrue(name in self.longOptions or name + '=' in self.longOptions, option)
+
+
+if __name__ == '__main__':
+    unittest.main()
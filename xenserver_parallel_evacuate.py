@@ -26,6 +26,8 @@
 import sys
 import os
 import getopt
+import heapq
+import re
 
 
 # Argument handling Class
@@ -35,12 +37,18 @@ class handleArguments(object):
         self.DRYRUN = 1
         self.threads = 5
         self.skip_checks = False
+        self.check_cluster = False
+        self.check_hosts = []
+        self.hosts = []
+        self.vcpu_ratio = 0
 
         # Usage message
-        help = "Usage: " + os.path.basename(__file__) + ' --threads [--debug --exec --skip-checks]'
+        help = "Usage: " + os.path.basename(__file__) + ' --threads [--debug --exec --skip-checks --hosts <host1,host2>]' + \
+            '\n       ' + os.path.basename(__file__) + ' --check-cluster [--vcpu-ratio <vcpus per cpu>]' + \
+            '\n       ' + os.path.basename(__file__) + ' --check-hosts <host1,host2> [--vcpu-ratio <vcpus per cpu>]'
 
         try:
-            opts, args = getopt.getopt(argv,"ht:",["threads=","debug","exec","skip-checks"])
+            opts, args = getopt.getopt(argv,"ht:",["threads=","debug","exec","skip-checks","check-cluster","check-hosts=","hosts=","vcpu-ratio="])
         except getopt.GetoptError:
             print help
             sys.exit(2)
@@ -56,6 +64,14 @@ class handleArguments(object):
                 self.DRYRUN = 0
             elif opt in ("--skip-checks"):
                 self.skip_checks = True
+            elif opt in ("--check-cluster"):
+                self.check_cluster = True
+            elif opt in ("--check-hosts"):
+                self.check_hosts = arg.replace(' ', '').split(',')
+            elif opt in ("--hosts"):
+                self.hosts = arg.replace(' ', '').split(',')
+            elif opt in ("--vcpu-ratio"):
+                self.vcpu_ratio = float(arg)
 
 # Class to handle XenServer parallel evactation
 class xenserver_parallel_evacuation(object):
@@ -68,6 +84,11 @@ class xenserver_parallel_evacuation(object):
         self.vmlist = False
         self.hvlist = False
         self.skip_checks = arg.skip_checks
+        # Hosts to empty with one migration plan, this host by default
+        self.hosts = arg.hosts
+        if len(self.hosts) == 0:
+            self.hosts = ['$HOSTNAME']
+        self.vcpu_ratio = arg.vcpu_ratio
 
     # Run local command
     def run_local_command(self, command):
@@ -93,17 +114,20 @@ class xenserver_parallel_evacuation(object):
                                            do echo -n \"$h,\"; \
                                            xe host-compute-free-memory host=$h;done")
 
-    # Get overview of VMs and their memory
+    # Get overview of VMs and their memory, of all hosts we empty
     def get_vms_with_memory_from_hypervisor(self, grep_for=None):
         try:
             grep_command = ""
             if grep_for is not None:
                 grep_command = "| grep %s" % grep_for
-            return self.run_local_command("xe vm-list resident-on=$(xe host-list params=uuid \
-                                           name-label=$HOSTNAME --minimal) \
-                                           params=name-label,memory-static-max is-control-domain=false |\
-                                           tr '\\n' ' ' | sed 's/name-label/\\n/g' | \
-                                           awk {'print $4 \",\" $8'} | sed '/^,$/d'" + grep_command)
+            vmlist = ""
+            for hostname in self.hosts:
+                vmlist += self.run_local_command("xe vm-list resident-on=$(xe host-list params=uuid \
+                                               name-label=" + hostname + " --minimal) \
+                                               params=name-label,memory-static-max is-control-domain=false |\
+                                               tr '\\n' ' ' | sed 's/name-label/\\n/g' | \
+                                               awk {'print $4 \",\" $8'} | sed '/^,$/d'" + grep_command) + "\n"
+            return vmlist
         except:
             return False
 
@@ -126,19 +150,185 @@ class xenserver_parallel_evacuation(object):
             poolmember[hv]['name'] = hv
         return poolmember
 
-    # Get the hypervisor with the most free memory
-    def get_hypervisor_with_most_free_memory(self):
-        if self.poolmember == False:
-            self.poolmember = self.construct_poolmembers()
-        return sorted(self.poolmember.items(),key = lambda x :x[1]['memory_free'],reverse = True)[:1][0][1]
+    # Pack vms (memory, name[, vcpus]) onto hypervisors and update their
+    # free memory. Returns a list of (vm, hypervisor) and the first vm that
+    # did not fit anywhere (None when all of them fit).
+    def pack_vms(self, vms, poolmember):
+        # First-fit-decreasing: place the biggest vms first, while there is
+        # still room for them. Small ones fit in the gaps that are left.
+        vms = vms[:]
+        vms.sort()
+        vms.reverse()
+
+        # Max-heap of the hypervisors by free memory, so the one with the
+        # most free memory is found without sorting all of them for every vm
+        hypervisors = []
+        for hv in poolmember.values():
+            heapq.heappush(hypervisors, (-hv['memory_free'], hv['name']))
+
+        plan = []
+        for vm in vms:
+            mem = vm[0]
+            vcpus = 0
+            if len(vm) > 2:
+                vcpus = vm[2]
+
+            # Most free memory first, skipping hypervisors without vcpus left
+            skipped = []
+            to_hv = None
+            while len(hypervisors) > 0:
+                memory_free, hv = heapq.heappop(hypervisors)
+                skipped.append((memory_free, hv))
+                # If the hv with the most memory cannot host this vm, we're in trouble
+                if -memory_free <= mem:
+                    break
+                if poolmember[hv].get('vcpus_free', vcpus) < vcpus:
+                    continue
+                to_hv = hv
+                skipped.pop()
+                break
+            for entry in skipped:
+                heapq.heappush(hypervisors, entry)
+            if to_hv is None:
+                return plan, vm
+
+            # update free_mem
+            poolmember[to_hv]['memory_free'] -= mem
+            if 'vcpus_free' in poolmember[to_hv]:
+                poolmember[to_hv]['vcpus_free'] -= vcpus
+            heapq.heappush(hypervisors, (-poolmember[to_hv]['memory_free'], to_hv))
+            plan.append((vm[1], to_hv))
+        return plan, None
+
+    # Parse the output of xe *-list commands into a list of dicts
+    def parse_xe_records(self, output):
+        records = []
+        record = {}
+        for line in output.split('\n'):
+            if line.strip() == "":
+                if record:
+                    records.append(record)
+                    record = {}
+                continue
+            try:
+                key, value = line.split(':', 1)
+            except:
+                continue
+            record[key.split('(')[0].strip()] = value.strip()
+        if record:
+            records.append(record)
+        return records
+
+    # Get all hosts of the pool, with the vms running on them
+    def construct_pool_inventory(self):
+        poolmember = self.construct_poolmembers()
+
+        hosts = {}
+        names = {}
+        for h in self.parse_xe_records(self.run_local_command("xe host-list params=uuid,name-label,cpu_info")):
+            cpu_count = 0
+            m = re.search('cpu_count: *([0-9]+)', h.get('cpu_info', ''))
+            if m:
+                cpu_count = int(m.group(1))
+            names[h['uuid']] = h['name-label']
+            hosts[h['name-label']] = {'name': h['name-label'], 'cpu_count': cpu_count, 'vms': []}
+
+        for vm in self.parse_xe_records(self.run_local_command("xe vm-list is-control-domain=false power-state=running \
+                                                               params=name-label,resident-on,memory-static-max,VCPUs-max")):
+            try:
+                host = names[vm['resident-on']]
+                hosts[host]['vms'].append((int(vm['memory-static-max']), vm['name-label'], int(vm['VCPUs-max'])))
+            except:
+                continue
+
+        # vcpus left on enabled hosts, when we also pack on vcpus
+        for host in hosts.values():
+            vcpus_used = 0
+            for vm in host['vms']:
+                vcpus_used += vm[2]
+            if host['name'] in poolmember and self.vcpu_ratio > 0:
+                poolmember[host['name']]['vcpus_free'] = int(host['cpu_count'] * self.vcpu_ratio) - vcpus_used
+        return hosts, poolmember
+
+    # Check whether the vms of these hosts, together, fit on the rest of the
+    # pool. That tells whether they can be emptied at the same time.
+    def check_hosts(self, hostnames):
+        hosts, poolmember = self.construct_pool_inventory()
+
+        vms = []
+        for hostname in hostnames:
+            if hostname not in hosts:
+                print "Error: host " + hostname + " is not part of this pool."
+                return False
+            vms += hosts[hostname]['vms']
+
+        targets = {}
+        for hv in poolmember.values():
+            if hv['name'] not in hostnames:
+                targets[hv['name']] = hv.copy()
+
+        plan, unplaced = self.pack_vms(vms, targets)
+        if unplaced is not None:
+            print "NOT OK: %s (%d MB) does not fit when emptying %s" % (unplaced[1], unplaced[0] / 1024 / 1024, ", ".join(hostnames))
+            return False
+        memory_left = 0
+        for hv in targets.values():
+            memory_left += hv['memory_free']
+        print "OK: %d vms of %s fit on the other hosts, leaving %d MB" % (len(vms), ", ".join(hostnames), memory_left / 1024 / 1024)
+        return True
+
+    # Check for every host whether its vms fit on the rest of the pool
+    def check_cluster(self):
+        hosts, poolmember = self.construct_pool_inventory()
+
+        print "%-30s %5s %12s %12s %12s  %s" % ("Host", "VMs", "Needed (MB)", "Free (MB)", "Left (MB)", "Result")
+        feasible = True
+        worst_headroom = None
+        hostnames = hosts.keys()
+        hostnames.sort()
+        for hostname in hostnames:
+            vms = hosts[hostname]['vms']
+
+            # Everything but the host itself, as it was before
+            targets = {}
+            for hv in poolmember.values():
+                if hv['name'] != hostname:
+                    targets[hv['name']] = hv.copy()
+            memory_free = 0
+            for hv in targets.values():
+                memory_free += hv['memory_free']
+            memory_needed = 0
+            for vm in vms:
+                memory_needed += vm[0]
+
+            plan, unplaced = self.pack_vms(vms, targets)
+            memory_left = 0
+            for hv in targets.values():
+                memory_left += hv['memory_free']
+            if unplaced is not None:
+                feasible = False
+                result = "NOT OK: %s (%d MB) does not fit" % (unplaced[1], unplaced[0] / 1024 / 1024)
+            else:
+                result = "OK"
+                if worst_headroom is None or memory_left < worst_headroom[0]:
+                    worst_headroom = (memory_left, hostname)
+            print "%-30s %5d %12d %12d %12d  %s" % (hostname, len(vms), memory_needed / 1024 / 1024,
+                                                    memory_free / 1024 / 1024, memory_left / 1024 / 1024, result)
+
+        if worst_headroom is not None:
+            print "Note: Worst-case headroom is %d MB, when emptying %s" % (worst_headroom[0] / 1024 / 1024, worst_headroom[1])
+        if not feasible:
+            print "Error: Not every host can be emptied onto the rest of the pool. This means N+1 rule is not met, please investigate!"
+        return feasible
 
     # Generate migration plan
     def generate_migration_plan(self, grep_for=None):
         if self.skip_checks is False:
-            # Make sure host is disabled
-            if self.is_host_enabled() is not False:
-                print "Error: Host should be disabled first."
-                return False
+            # Make sure the hosts are disabled, so they do not receive vms
+            for hostname in self.hosts:
+                if self.is_host_enabled(hostname) is not False:
+                    print "Error: Host should be disabled first."
+                    return False
 
             # Make sure pool HA is turned off
             if self.pool_ha_check() is not False:
@@ -152,6 +342,7 @@ class xenserver_parallel_evacuation(object):
 
         vmlist_iter = self.vmlist.split('\n')
 
+        vms = []
         for vm in vmlist_iter:
             info = vm.split(',')
             try:
@@ -159,22 +350,21 @@ class xenserver_parallel_evacuation(object):
                 mem = int(info[1].strip())
             except:
                 continue
+            vms.append((mem, vm))
+
+        if self.poolmember == False:
+            self.poolmember = self.construct_poolmembers()
 
-            while True:
-                to_hv = self.get_hypervisor_with_most_free_memory()
+        plan, unplaced = self.pack_vms(vms, self.poolmember)
+        if unplaced is not None:
+            # Unable to empty this hv
+            print "Error: not enough memory (need: " + str(unplaced[0])  + ") on any hypervisor to migrate vm " + unplaced[1] + ". This means N+1 rule is not met, please investigate!"
+            return False
 
-                # If the hv with the most memory cannot host this vm, we're in trouble
-                if to_hv['memory_free'] > mem:
-                    # update free_mem
-                    self.poolmember[to_hv['name']]['memory_free'] -= int(mem)
-                    # Prepare migration command
-                    migration_cmds += "xe vm-migrate vm=" + vm + " host=" + to_hv['name'] + ";\n"
-                    print "OK, found migration destination for " + vm
-                    break
-                else:
-                    # Unable to empty this hv
-                    print "Error: not enough memory (need: " + str(mem)  + ") on any hypervisor to migrate vm " + vm + ". This means N+1 rule is not met, please investigate!"
-                    return False
+        for vm, to_hv in plan:
+            # Prepare migration command
+            migration_cmds += "xe vm-migrate vm=" + vm + " host=" + to_hv + ";\n"
+            print "OK, found migration destination for " + vm
         return migration_cmds
 
     # Execute migration plan
@@ -189,10 +379,10 @@ class xenserver_parallel_evacuation(object):
              return False
 
     # Is host enabled?
-    def is_host_enabled(self):
+    def is_host_enabled(self, hostname='$HOSTNAME'):
         print "Note: Checking if host is enabled or disabled.."
         try:
-            if self.run_local_command("xe host-list params=enabled name-label=$HOSTNAME --minimal").strip() == "true":
+            if self.run_local_command("xe host-list params=enabled name-label=" + hostname + " --minimal").strip() == "true":
                 return True
             else:
                 return False
@@ -218,6 +408,16 @@ if __name__ == "__main__":
     # Init our class
     x = xenserver_parallel_evacuation(arg)
 
+    if arg.check_cluster:
+        if x.check_cluster():
+            sys.exit(0)
+        sys.exit(1)
+
+    if len(arg.check_hosts) > 0:
+        if x.check_hosts(arg.check_hosts):
+            sys.exit(0)
+        sys.exit(1)
+
     if arg.DRYRUN == 1:
         print "Note: Running in DRY-run mode, not executing. Use --exec to execute."
         print "Note: Calculating migration plan.."
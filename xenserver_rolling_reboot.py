@@ -66,6 +66,8 @@ def handleArguments(argv):
     patch_list_file = 'xenserver_patches_to_install.txt'
     global preserve_downloads
     preserve_downloads = False
+    global max_concurrent_hosts
+    max_concurrent_hosts = 1
 
     # Usage message
     help = "Usage: ./" + os.path.basename(__file__) + ' [options]' + \
@@ -75,12 +77,14 @@ def handleArguments(argv):
         '\n  --ignore-hosts <list>\t\t\t\tSkip work on the specified hosts (for example if you need to resume): ' \
         'Example: --ignore-hosts="host1, host2" ' + \
         '\n  --threads <nr>\t\t\t\tUse this number or concurrent migration threads ' + \
+        '\n  --max-concurrent-hosts <nr>\t\t\tReboot up to this number of hosts (after the poolmaster) at the ' \
+        'same time, when the others have enough free memory for their VMs (default 1)' + \
         '\n  --halt\t\t\t\t\tInstead of the default reboot, halt the hypervisor (useful in case of hardware ' \
         'upgrades) ' + \
         '\n  --pre-empty-script\t\t\t\tBash script to run on hypervisor before starting the live migrations to empty ' \
         'hypervisor (expected in same folder as this script)' + \
         '\n  --post-empty-script\t\t\t\tBash script to run on hypervisor after a hypervisor has no more VMs running' \
-        '\n  --patch-list-file\t\t\t\tText file with URLs of patches to download and install. One per line. ' \
+        '\n  --patch-list-file\t\t\t\tText file with URLs of patches to download and install. One per line, optionally followed by its sha256. ' \
         '(expected in same folder as this script)' + \
         '\n  --preserve-downloads\t\t\t\tPreserve downloads instead of wiping them and downloading again.' + \
         '\n  --debug\t\t\t\t\tEnable debug mode' + \
@@ -90,8 +94,9 @@ def handleArguments(argv):
     try:
         opts, args = getopt.getopt(
             argv, "hc:n:t:p", [
-                "credentials-file=", "clustername=", "ignore-hosts=", "threads=", "pre-empty-script=",
-                "post-empty-script=", "patch-list-file=", "preserve-downloads", "halt", "debug", "exec", "prepare"])
+                "config-profile=", "credentials-file=", "clustername=", "ignore-hosts=", "threads=", "pre-empty-script=",
+                "post-empty-script=", "patch-list-file=", "preserve-downloads", "max-concurrent-hosts=", "halt", "debug", "exec",
+                "prepare"])
     except getopt.GetoptError as e:
         print "Error: " + str(e)
         print help
@@ -119,6 +124,8 @@ def handleArguments(argv):
             patch_list_file = arg
         elif opt in ("--preserve-downloads"):
             preserve_downloads = True
+        elif opt in ("--max-concurrent-hosts"):
+            max_concurrent_hosts = int(arg)
         elif opt in ("--debug"):
             DEBUG = 1
         elif opt in ("--exec"):
@@ -151,6 +158,7 @@ c = cloudstackops.CloudStackOps(DEBUG, DRYRUN)
 # Init XenServer class
 x = xenserver.xenserver('root', threads, pre_empty_script, post_empty_script)
 c.xenserver = x
+x.cloudstackops = c
 
 # make credentials file known to our class
 c.configProfileName = configProfileName
@@ -193,12 +201,16 @@ if not poolmaster_name:
     sys.exit(1)
 print "Note: The poolmaster of cluster " + clustername + " is " + poolmaster_name
 
-# Put the scripts we need
-for h in cluster_hosts:
+# Put the scripts we need, on all hosts at the same time
+def prepare_host(h):
     x.put_scripts(h)
     if DRYRUN == 0 or PREPARE == 1:
         x.fake_pv_tools(h)
         x.create_vlans(h)
+    return True
+
+x.fan_out(cluster_hosts, prepare_host)
+for h in cluster_hosts:
     if h.name == poolmaster_name:
         poolmaster = h
 
@@ -212,6 +224,15 @@ if DRYRUN == 0 or PREPARE == 1:
 checkBonds = True
 c.printHypervisors(clusterID, poolmaster.name, checkBonds)
 
+# Make sure N+1 holds for every host before we start, not halfway
+capacity_ok = x.check_cluster_capacity(poolmaster)
+if capacity_ok is False:
+    print "Error: Not every hypervisor of cluster " + clustername + " can be emptied onto the others."
+    if DRYRUN == 0:
+        print "Error: Halting, please investigate."
+        disconnect_all()
+        sys.exit(1)
+
 if halt_hypervisor:
     print "Warning: Instead of reboot, we will halt the hypervisor. You need to start it yourself for the script to" \
           " continue moving to the next hypervisor."
@@ -221,6 +242,7 @@ if DRYRUN == 1:
     print "Warning: We are running in DRYRUN mode."
     print
     print "This script will: "
+    print "  - Check every hypervisor of " + clustername + " can be emptied onto the others (N+1)"
     print "  - Set cluster " + clustername + " to Unmanage"
     print "  - Turn OFF XenServer poolHA for " + clustername
     print "  - For any hypervisor it will do this (poolmaster " + poolmaster.name + " first):"
@@ -234,6 +256,8 @@ if DRYRUN == 1:
     print "      - will wait for it to come back online (checks SSH connection)"
     print "      - set the hypervisor to Enabled in XenServer"
     print "      - continues to the next hypervisor"
+    print "      - (after the poolmaster, up to " + str(max_concurrent_hosts) + " hypervisors at the same time when the" \
+          " others have enough free memory)"
     print "  - When the rebooting is done, it enables XenServer poolHA again for " + clustername
     print "  - Finally, it sets the " + clustername + " to Managed again"
     print "  - Database will be updated according to the new situation"
@@ -281,7 +305,7 @@ if poolmaster.name not in ignoreHosts:
     # Download all XenServer patches
     if not preserve_downloads:
         print "Note: Deleting previously downloaded patches"
-        files = glob.glob('xenserver_patches/*.zip')
+        files = glob.glob('xenserver_patches/*.zip') + glob.glob('xenserver_patches/*.part')
         for f in files:
             print "Note: Removing previously downloaded patch " + f
             os.remove(f)
@@ -290,9 +314,8 @@ if poolmaster.name not in ignoreHosts:
     with open(patch_list_file) as file_pointer:
         patches = file_pointer.read().splitlines()
 
-    for patch_url in patches:
-        print "Note: Processing patch '%s'" % patch_url
-        x.download_patch(patch_url)
+    if not x.download_patches(patches):
+        print "Warning: Not all patches could be downloaded, continuing with the ones we have."
 
     # Upload the patches to poolmaster, then to XenServer
     x.put_patches_to_poolmaster(poolmaster)
@@ -323,8 +346,9 @@ if poolmaster.name not in ignoreHosts:
         disconnect_all()
         sys.exit(1)
 
-    print "Note: Waiting 60s to allow all hosts connect.."
-    time.sleep(60)
+    print "Note: Waiting for all hosts to connect.."
+    if not c.waitForClusterHostsUp(clusterID, 600):
+        print "Warning: Not all hosts of cluster " + clustername + " are Up after 600s, continuing anyway."
 
 else:
         print "Warning: Skipping " + poolmaster.name + " due to --ignore-hosts setting"
@@ -337,7 +361,8 @@ c.printHypervisors(clusterID, poolmaster.name, checkBonds)
 print "Note: Some info about cluster '" + clustername + "':"
 c.printCluster(clusterID)
 
-# Then the other hypervisors, one-by-one
+# Then the other hypervisors, in waves of up to --max-concurrent-hosts
+remaining_hosts = []
 for h in cluster_hosts:
     if h.name in ignoreHosts:
         print "Warning: Skipping " + h.name + " due to --ignore-hosts setting"
@@ -346,21 +371,66 @@ for h in cluster_hosts:
     if h.name == poolmaster.name:
         print "Note: Skipping poolmaster"
         continue
-    vm_count = x.host_get_vms(h)
-    if vm_count:
+    remaining_hosts.append(h)
+
+# Stop the sequence halfway a wave, this does not return. The hosts of the
+# wave that went offline already are waited for and enabled again, the
+# others are rolled back.
+def abort_wave(wave, rebooted):
+    if len(rebooted) > 0:
+        print "Note: Waiting for " + ", ".join([h.name for h in rebooted]) + " to return before stopping."
+        results = x.fan_out(rebooted, x.host_wait_for_return)
+        for h in rebooted:
+            if results.get(h.name) is not True:
+                print "Error: Host " + h.name + " did not return properly. Please investigate."
+    for h in wave:
+        if h not in rebooted:
+            x.roll_back(h)
+    disconnect_all()
+    sys.exit(1)
+
+while len(remaining_hosts) > 0:
+    # Add hosts to the wave as long as the VMs of all of them fit on the others
+    wave = [remaining_hosts.pop(0)]
+    while len(wave) < max_concurrent_hosts and len(remaining_hosts) > 0:
+        if not x.check_hosts_capacity(poolmaster, wave + [remaining_hosts[0]]):
+            break
+        wave.append(remaining_hosts.pop(0))
+
+    for h in wave:
+        vm_count = x.host_get_vms(h)
+        if not vm_count:
+            print "Error: Unable to get vm_count from host " + h.name
+            abort_wave(wave, [])
         print "Note: " + h.name + " has " + vm_count + " VMs running."
-        reboot_result = x.host_reboot(h, halt_hypervisor)
-        if reboot_result is False:
+
+    if len(wave) == 1:
+        if x.host_reboot(wave[0], halt_hypervisor) is False:
             print "Error: Stopping sequence, as a reboot failed. Please investigate."
-            x.roll_back(h)
-            disconnect_all()
-            sys.exit(1)
+            abort_wave(wave, [])
     else:
-        print "Error: Unable to get vm_count from host " + h.name
-        x.roll_back(h)
-        disconnect_all()
-        sys.exit(1)
-    print "Note: We completed host " + h.name + " successfully."
+        print "Note: Rebooting " + ", ".join([h.name for h in wave]) + " at the same time."
+        # Empty them together, with one migration plan for all of them
+        if x.hosts_empty(wave) is False:
+            print "Error: Stopping sequence, as emptying the hosts failed. Please investigate."
+            abort_wave(wave, [])
+
+        # Reboot them together, and wait for all of them to return
+        results = x.fan_out(wave, x.host_restart, halt_hypervisor)
+        rebooted = [h for h in wave if results.get(h.name) is True]
+        if len(rebooted) < len(wave):
+            print "Error: Stopping sequence, as a reboot failed. Please investigate."
+            abort_wave(wave, rebooted)
+        results = x.fan_out(wave, x.host_wait_for_return)
+        for h in wave:
+            if results.get(h.name) is not True:
+                print "Error: Stopping sequence, as host " + h.name + " did not return properly. Please investigate."
+                x.roll_back(h)
+                disconnect_all()
+                sys.exit(1)
+
+    for h in wave:
+        print "Note: We completed host " + h.name + " successfully."
 
     # Print overview
     checkBonds = True
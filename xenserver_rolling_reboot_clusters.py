@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+#      Copyright 2015, Schuberg Philis BV
+#
+#      Licensed to the Apache Software Foundation (ASF) under one
+#      or more contributor license agreements.  See the NOTICE file
+#      distributed with this work for additional information
+#      regarding copyright ownership.  The ASF licenses this file
+#      to you under the Apache License, Version 2.0 (the
+#      "License"); you may not use this file except in compliance
+#      with the License.  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#      Unless required by applicable law or agreed to in writing,
+#      software distributed under the License is distributed on an
+#      "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#      KIND, either express or implied.  See the License for the
+#      specific language governing permissions and limitations
+#      under the License.
+
+# Rolling reboot of several XenServer clusters at the same time
+# Remi Bergsma, rbergsma@schubergphilis.com
+
+# We depend on these modules
+import sys
+import time
+import os
+import getopt
+import glob
+import subprocess
+from multiprocessing.pool import ThreadPool
+from cloudstackops import cloudstackops
+from cloudstackops import xenserver
+from prettytable import PrettyTable
+
+
+# Handle arguments passed
+def handleArguments(argv):
+    global DEBUG
+    DEBUG = 0
+    global DRYRUN
+    DRYRUN = 1
+    global configProfileName
+    configProfileName = ''
+    global clusterList
+    clusterList = ''
+    global zonename
+    zonename = ''
+    global maxConcurrentClusters
+    maxConcurrentClusters = 2
+    global logDir
+    logDir = 'rolling_reboot_logs'
+    global patch_list_file
+    patch_list_file = 'xenserver_patches_to_install.txt'
+    global preserve_downloads
+    preserve_downloads = False
+    global passThrough
+    passThrough = []
+
+    # Usage message
+    help = "Usage: ./" + os.path.basename(__file__) + ' [options]' + \
+        '\n  --config-profile -c <profilename>\t\tSpecify the CloudMonkey profile name to ' \
+        'get the credentials from (or specify in ./config file)' + \
+        '\n  --clusters <list>\t\t\t\tNames of the clusters to work with. Example: --clusters="cluster1, cluster2"' + \
+        '\n  --zone -z <zonename>\t\t\t\tWork with all XenServer clusters of this zone' + \
+        '\n  --max-concurrent-clusters <nr>\t\tReboot this number of clusters at the same time (default 2)' + \
+        '\n  --log-dir <directory>\t\t\t\tWrite the output of each cluster to a log file in this directory ' \
+        '(default rolling_reboot_logs)' + \
+        '\n  --ignore-hosts <list>\t\t\t\tSkip work on the specified hosts' + \
+        '\n  --threads <nr>\t\t\t\tUse this number or concurrent migration threads ' + \
+        '\n  --max-concurrent-hosts <nr>\t\t\tReboot up to this number of hosts per cluster at the same time' + \
+        '\n  --halt\t\t\t\t\tInstead of the default reboot, halt the hypervisor' + \
+        '\n  --pre-empty-script\t\t\t\tBash script to run on hypervisor before starting the live migrations' + \
+        '\n  --post-empty-script\t\t\t\tBash script to run on hypervisor after a hypervisor has no more VMs running' \
+        '\n  --patch-list-file\t\t\t\tText file with URLs of patches to download and install. One per line, optionally followed by its sha256.' + \
+        '\n  --preserve-downloads\t\t\t\tPreserve downloads instead of wiping them and downloading again.' + \
+        '\n  --debug\t\t\t\t\tEnable debug mode' + \
+        '\n  --exec\t\t\t\t\tExecute for real'
+
+    try:
+        opts, args = getopt.getopt(
+            argv, "hc:z:t:", [
+                "config-profile=", "clusters=", "zone=", "max-concurrent-clusters=", "log-dir=", "ignore-hosts=",
+                "threads=", "max-concurrent-hosts=", "pre-empty-script=", "post-empty-script=", "patch-list-file=",
+                "preserve-downloads", "halt", "debug", "exec"])
+    except getopt.GetoptError as e:
+        print "Error: " + str(e)
+        print help
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print help
+            sys.exit()
+        elif opt in ("-c", "--config-profile"):
+            configProfileName = arg
+        elif opt in ("--clusters"):
+            clusterList = arg
+        elif opt in ("-z", "--zone"):
+            zonename = arg
+        elif opt in ("--max-concurrent-clusters"):
+            maxConcurrentClusters = int(arg)
+        elif opt in ("--log-dir"):
+            logDir = arg
+        elif opt in ("-t", "--threads"):
+            passThrough += ["--threads", arg]
+        elif opt in ("--ignore-hosts", "--max-concurrent-hosts", "--pre-empty-script", "--post-empty-script"):
+            passThrough += [opt, arg]
+        elif opt in ("--halt"):
+            passThrough += [opt]
+        elif opt in ("--patch-list-file"):
+            patch_list_file = arg
+        elif opt in ("--preserve-downloads"):
+            preserve_downloads = True
+        elif opt in ("--debug"):
+            DEBUG = 1
+            passThrough += [opt]
+        elif opt in ("--exec"):
+            DRYRUN = 0
+            passThrough += [opt]
+
+    # Default to cloudmonkey default config file
+    if len(configProfileName) == 0:
+        configProfileName = "config"
+
+    # We need clusters or a zone
+    if len(clusterList) == 0 and len(zonename) == 0:
+        print help
+        sys.exit(1)
+
+
+# The arguments for xenserver_rolling_reboot.py to do one cluster
+def rebootClusterArguments(clustername):
+    return ['--config-profile', configProfileName,
+            '--clustername', clustername,
+            '--patch-list-file', patch_list_file,
+            # Patches were downloaded already, by us
+            '--preserve-downloads'] + passThrough
+
+
+# Run the rolling reboot of one cluster, returns its exit code and the last
+# error it logged
+def rebootCluster(clustername):
+    logFile = logDir + '/' + clustername + '.log'
+    print "Note: Starting cluster " + clustername + " @ " + time.strftime("%Y-%m-%d %H:%M") + ", logging to " + logFile
+    command = [sys.executable, os.path.dirname(os.path.abspath(__file__)) + '/xenserver_rolling_reboot.py'] + \
+        rebootClusterArguments(clustername)
+    log = open(logFile, 'a')
+    start = log.tell()
+    try:
+        retcode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+    finally:
+        log.close()
+    print "Note: Finished cluster " + clustername + " @ " + time.strftime("%Y-%m-%d %H:%M") + " with return code " + \
+        str(retcode)
+
+    lastError = ""
+    with open(logFile) as log:
+        log.seek(start)
+        for line in log:
+            if line.startswith("Error:"):
+                lastError = line.strip()
+    return retcode, lastError
+
+
+if __name__ == '__main__':
+    handleArguments(sys.argv[1:])
+
+# Init CloudStack class
+c = cloudstackops.CloudStackOps(DEBUG, DRYRUN)
+
+# make credentials file known to our class
+c.configProfileName = configProfileName
+
+# Init the CloudStack API
+c.initCloudStackAPI()
+
+if DEBUG == 1:
+    print "API address: " + c.apiurl
+    print "ApiKey: " + c.apikey
+    print "SecretKey: " + c.secretkey
+
+# Find the clusters to work with
+if len(zonename) > 0:
+    zoneID = c.checkCloudStackName({'csname': zonename, 'csApiCall': 'listZones'})
+    if zoneID == 1:
+        print "Error: Could not find zone '" + zonename + "'."
+        sys.exit(1)
+    clusterData = c.listClusters({'zoneid': zoneID, 'hypervisor': 'XenServer'})
+    if clusterData is None or clusterData == 1:
+        print "Error: Could not find XenServer clusters in zone '" + zonename + "'."
+        sys.exit(1)
+    clusters = sorted([cluster.name for cluster in clusterData])
+else:
+    clusters = clusterList.replace(' ', '').split(",")
+    clusterIDs = c.checkCloudStackNames({'csnames': clusters, 'csApiCall': 'listClusters'})
+    if clusterIDs == 1 or len(clusterIDs) != len(set(clusters)):
+        print "Error: Could not find all clusters. Halting."
+        sys.exit(1)
+
+print "Note: Working on clusters " + ", ".join(clusters) + ", " + str(maxConcurrentClusters) + " at the same time"
+
+if not os.path.exists(logDir):
+    os.makedirs(logDir)
+
+# Download the patches once, instead of all clusters at the same time
+if DRYRUN == 0:
+    x = xenserver.xenserver()
+    if not preserve_downloads:
+        print "Note: Deleting previously downloaded patches"
+        for f in glob.glob('xenserver_patches/*.zip') + glob.glob('xenserver_patches/*.part'):
+            print "Note: Removing previously downloaded patch " + f
+            os.remove(f)
+
+    print "Note: Reading patches list '%s'" % patch_list_file
+    with open(patch_list_file) as file_pointer:
+        patches = file_pointer.read().splitlines()
+
+    if not x.download_patches(patches):
+        print "Error: Not all patches could be downloaded. Halting."
+        sys.exit(1)
+
+# The clusters are independent XenServer pools, do several at once
+print "Note: Starting @ " + time.strftime("%Y-%m-%d %H:%M")
+pool = ThreadPool(max(1, min(maxConcurrentClusters, len(clusters))))
+results = pool.map(rebootCluster, clusters)
+pool.close()
+pool.join()
+
+# Summary
+t = PrettyTable(["Cluster", "Result", "Last error", "Log file"])
+t.align["Cluster"] = "l"
+t.align["Last error"] = "l"
+failed = 0
+for clustername, (retcode, lastError) in zip(clusters, results):
+    if DRYRUN == 1:
+        result = "Dry run"
+    elif retcode == 0:
+        result = "OK"
+    else:
+        result = "FAILED (" + str(retcode) + ")"
+        failed += 1
+    t.add_row([clustername, result, lastError, logDir + '/' + clustername + '.log'])
+print t
+
+print "Note: Finished @ " + time.strftime("%Y-%m-%d %H:%M")
+if failed > 0:
+    print "Error: " + str(failed) + " cluster(s) failed, please investigate their log files."
+    sys.exit(1)